@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+Heart rate, RR variability and intervals of electrocardiogram recordings.
+
+QRS complexes are detected as in the Pan-Tompkins algorithm: the leads
+are band-pass filtered (5-15 Hz), differentiated and squared, their sum
+is integrated over a 150 ms moving window. All the steps work on whole
+arrays, a segment of the recording at a time; instead of updating the
+thresholds at each peak, a peak is a QRS if it exceeds a fraction of
+the largest peak in the surrounding seconds, then long RR intervals are
+searched back with a lower threshold. Samples near missing values are
+ignored, lead by lead.
+
+The PR, QRS and QT intervals are measured on the median beat of all
+the leads, by means of its spatial magnitude: onsets and offsets of
+the P and T waves are found with the tangent method.
+
+Results are dictionaries: they can be printed on the report header by
+ecg_plot and stored into the SCP-ECG Section #7 (global measurements)
+by ecg.export_scp(). analyze_files() processes many recordings using
+a pool of processes.
+
+Required custom modules: ecg_contec.py, ecg_scp.py, ecg_filter.py, ecg_catalog.py
+Required Python packages: python3-numpy python3-scipy
+"""
+
+import ecg_catalog
+import ecg_contec as contec
+import ecg_filter
+import ecg_scp as scp
+import math
+import os
+import time
+import warnings
+import numpy as np
+
+__author__ = "Niccolo Rigacci"
+__copyright__ = "Copyright 2020 Niccolo Rigacci <niccolo@rigacci.org>"
+__license__ = "GPLv3-or-later"
+__email__ = "niccolo@rigacci.org"
+__version__ = "0.1.0"
+
+# Leads acquired by the ECG90A (II, III, V1-V6), the others are derived from II and III.
+ACQUIRED_LEADS = [1, 2, 6, 7, 8, 9, 10, 11]
+# Pan-Tompkins band-pass (Hz) and integration window (s).
+QRS_BAND = (5.0, 15.0)
+INTEGRATION_WINDOW = 0.150
+# No QRS can follow another one before this time (s).
+REFRACTORY = 0.200
+# A peak is a QRS if it exceeds THRESHOLD times the largest peak within +/- THRESHOLD_WINDOW s.
+THRESHOLD = 0.3
+THRESHOLD_WINDOW = 2.5
+# RR intervals longer than SEARCH_BACK times the median are searched again at half threshold.
+SEARCH_BACK = 1.66
+# Longest RR interval (ms) used for heart rate and variability.
+MAX_RR = 3000.0
+# Samples within MISSING_MARGIN s from a missing value are ignored.
+MISSING_MARGIN = 0.5
+# Samples processed at once, plus overlap on each side (s).
+SEGMENT = 300.0
+SEGMENT_OVERLAP = 3.0
+# Median beat: time before and after the R peak (s), beats used.
+BEAT_PRE = 0.35
+BEAT_POST = 0.60
+MEDIAN_BEATS = 500
+# Only beats with RR intervals within this ratio of the median are averaged.
+NORMAL_RR = (0.8, 1.2)
+# Most QRS types that an SCP-ECG Section #7 can list.
+MAX_SCP_QRS = 65535
+# Band-pass (Hz) of the median beat.
+BEAT_BAND = (0.5, 40.0)
+# QRS onset/offset where the slope drops under this fraction of the QRS maximum.
+QRS_SLOPE = 0.1
+# P and T waves lower than this fraction of the R peak are not present.
+WAVE_MIN = 0.03
+
+
+def qrs_feature(x, fs):
+    """ Return the Pan-Tompkins integrated signal and the band-passed leads """
+    # x is (leads x samples), missing values are numpy.nan.
+    from scipy.ndimage import maximum_filter1d, uniform_filter1d
+    missing = np.isnan(x)
+    x = np.where(missing, 0.0, x)
+    chain = ecg_filter.filter_chain(fs).highpass(QRS_BAND[0]).lowpass(QRS_BAND[1])
+    y = chain.apply(x)
+    # Five-point derivative, squared and summed over the leads.
+    d = np.zeros_like(y)
+    d[:, 2:-2] = (2.0 * (y[:, 3:-1] - y[:, 1:-3]) + y[:, 4:] - y[:, :-4]) * (fs / 8.0)
+    margin = int(MISSING_MARGIN * fs)
+    if missing.any():
+        near = maximum_filter1d(missing.astype(np.uint8), 2 * margin + 1, axis=1).astype(bool)
+        d[near] = 0.0
+        y[near] = 0.0
+    mwi = uniform_filter1d((d * d).sum(axis=0), max(1, int(round(INTEGRATION_WINDOW * fs))))
+    return (mwi, y)
+
+
+def detect_segment(x, fs):
+    """ Return (candidates, heights, thresholds, R peaks refined) of a segment """
+    from scipy.ndimage import maximum_filter1d
+    from scipy.signal import find_peaks
+    mwi, y = qrs_feature(x, fs)
+    candidates, props = find_peaks(mwi, height=np.finfo(np.float64).tiny, distance=max(1, int(REFRACTORY * fs)))
+    heights = props['peak_heights']
+    local = maximum_filter1d(mwi, 2 * int(THRESHOLD_WINDOW * fs) + 1)
+    thresholds = THRESHOLD * local[candidates]
+    # The R peak is the maximum of the band-passed energy near the integrated peak.
+    half = int(INTEGRATION_WINDOW * fs / 2)
+    energy = (y * y).sum(axis=0)
+    index = np.clip(candidates[:, None] + np.arange(-half, half + 1)[None, :], 0, len(energy) - 1)
+    refined = index[np.arange(len(candidates)), np.argmax(energy[index], axis=1)] if len(candidates) > 0 else candidates
+    return (candidates, heights, thresholds, refined)
+
+
+def detect_qrs(window, samples, fs):
+    """ Return the R peak indexes, reading (leads x rows) data by window(row0, row1) """
+    # Segments overlap, so filters and thresholds are not affected by
+    # the segment edges; peaks are taken from the core of each segment.
+    seg = int(SEGMENT * fs)
+    pad = int(SEGMENT_OVERLAP * fs)
+    found = []
+    for start in range(0, samples, seg):
+        lo = max(0, start - pad)
+        hi = min(samples, start + seg + pad)
+        candidates, heights, thresholds, refined = detect_segment(window(lo, hi), fs)
+        core = (candidates + lo >= start) & (candidates + lo < start + seg)
+        found.append((refined[core] + lo, heights[core], thresholds[core]))
+    if len(found) == 0:
+        return np.zeros(0, dtype=np.int64)
+    peaks = np.concatenate([f[0] for f in found]).astype(np.int64)
+    heights = np.concatenate([f[1] for f in found])
+    thresholds = np.concatenate([f[2] for f in found])
+    accepted = heights > thresholds
+    # Search back: the highest candidate into a long RR interval, if
+    # over half threshold and not into the refractory period.
+    r = peaks[accepted]
+    if len(r) > 2:
+        rr = np.diff(r)
+        limit = SEARCH_BACK * np.median(rr)
+        refractory = int(REFRACTORY * fs)
+        for k in np.flatnonzero(rr > limit):
+            inside = (peaks > r[k] + refractory) & (peaks < r[k + 1] - refractory) & ~accepted & (heights > thresholds * 0.5)
+            if inside.any():
+                j = np.flatnonzero(inside)
+                accepted[j[np.argmax(heights[j])]] = True
+    return np.unique(peaks[accepted])
+
+
+def median_beat(window, samples, fs, r_peaks, rr):
+    """ Return the (leads x samples) median beat, R peak at BEAT_PRE, None if no beats """
+    pre = int(BEAT_PRE * fs)
+    post = int(BEAT_POST * fs)
+    pad = int(fs)
+    median_rr = np.median(rr)
+    normal = np.ones(len(r_peaks), dtype=bool)
+    normal[1:] &= (rr >= NORMAL_RR[0] * median_rr) & (rr <= NORMAL_RR[1] * median_rr)
+    normal &= (r_peaks - pre - pad >= 0) & (r_peaks + post + pad < samples)
+    beats = r_peaks[normal]
+    if len(beats) == 0:
+        return None
+    beats = beats[np.linspace(0, len(beats) - 1, min(MEDIAN_BEATS, len(beats))).astype(np.int64)]
+    w = np.stack([window(b - pre - pad, b + post + pad) for b in beats])
+    missing = np.isnan(w).any(axis=2)
+    chain = ecg_filter.filter_chain(fs).highpass(BEAT_BAND[0]).lowpass(BEAT_BAND[1])
+    flat = np.where(np.isnan(w), 0.0, w).reshape((-1, w.shape[2]))
+    f = chain.apply(flat).reshape(w.shape)[:, :, pad:-pad]
+    f[missing] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        beat = np.nanmedian(f, axis=0)
+    beat = beat[~np.isnan(beat).any(axis=1)]
+    return beat if len(beat) > 0 else None
+
+
+def tangent_crossing(mag, slope, i):
+    """ Return where the tangent to mag at sample i crosses zero """
+    if slope[i] == 0:
+        return None
+    return i - mag[i] / slope[i]
+
+
+def wave_boundaries(beat, fs):
+    """ Return the P, QRS and T onsets/offsets (samples into the median beat), None if not found """
+    r = int(BEAT_PRE * fs)
+    n = beat.shape[1]
+    d = np.abs(np.gradient(beat, axis=1)).sum(axis=0)
+    s_max = d[max(0, r - int(0.05 * fs)):r + int(0.05 * fs)].max()
+    m = {'p_onset': None, 'p_offset': None, 'qrs_onset': None, 'qrs_offset': None, 't_offset': None, 'p_present': False}
+    if s_max <= 0:
+        return m
+    # QRS onset and offset: where the slope drops, searching from R.
+    low = d < QRS_SLOPE * s_max
+    before = np.flatnonzero(low[max(0, r - int(0.15 * fs)):r])
+    after = np.flatnonzero(low[r:min(n, r + int(0.2 * fs))])
+    if len(before) == 0 or len(after) == 0:
+        return m
+    onset = max(0, r - int(0.15 * fs)) + before[-1]
+    offset = r + after[0]
+    m['qrs_onset'], m['qrs_offset'] = onset, offset
+    # Spatial magnitude, baseline taken just before the QRS onset.
+    base = beat[:, max(0, onset - int(0.02 * fs)):onset + 1].mean(axis=1)
+    mag = np.sqrt(((beat - base[:, None]) ** 2).sum(axis=0))
+    slope = np.gradient(mag)
+    peak = mag[r]
+    # T wave: highest magnitude after the QRS, offset on the descending tangent.
+    t0 = offset + int(0.06 * fs)
+    if t0 < n - 2:
+        tp = t0 + np.argmax(mag[t0:])
+        if mag[tp] >= WAVE_MIN * peak and tp < n - 2:
+            i = tp + np.argmin(slope[tp:min(n, tp + int(0.2 * fs))])
+            t_end = tangent_crossing(mag, slope, i) if slope[i] < 0 else None
+            if t_end is not None and t_end < n:
+                m['t_offset'] = t_end
+    # P wave: highest magnitude before the QRS, onset and offset on the tangents.
+    p0 = max(0, onset - int(0.30 * fs))
+    p1 = onset - int(0.04 * fs)
+    if p1 - p0 > 2:
+        pp = p0 + np.argmax(mag[p0:p1])
+        if mag[pp] >= WAVE_MIN * peak and pp > p0:
+            m['p_present'] = True
+            i = p0 + np.argmax(slope[p0:pp])
+            j = pp + np.argmin(slope[pp:onset])
+            if slope[i] > 0:
+                m['p_onset'] = max(0.0, tangent_crossing(mag, slope, i))
+            if slope[j] < 0:
+                m['p_offset'] = min(float(onset), tangent_crossing(mag, slope, j))
+    return m
+
+
+def analyze_window(window, samples, fs):
+    """ Return the measurements of a recording, reading (leads x rows) data by window(row0, row1) """
+    r_peaks = detect_qrs(window, samples, fs)
+    result = {
+        'samples': int(samples),
+        'sample_rate': fs,
+        'r_peaks': r_peaks,
+        'beats': len(r_peaks),
+        'heart_rate': None, 'rr_mean': None, 'rr_sdnn': None, 'rr_rmssd': None, 'rr_min': None, 'rr_max': None,
+        'p_onset': None, 'p_offset': None, 'qrs_onset': None, 'qrs_offset': None, 't_offset': None, 'p_present': False,
+        'pr': None, 'qrs': None, 'qt': None, 'qtc': None}
+    if len(r_peaks) < 3:
+        return result
+    # RR intervals longer than MAX_RR (e.g. spanning missing data) are discarded.
+    rr = np.diff(r_peaks) * (1000.0 / fs)
+    valid = rr < MAX_RR
+    if valid.sum() >= 2:
+        v = rr[valid]
+        result['rr_mean'] = float(v.mean())
+        result['heart_rate'] = 60000.0 / result['rr_mean']
+        result['rr_sdnn'] = float(v.std(ddof=1))
+        result['rr_min'] = float(v.min())
+        result['rr_max'] = float(v.max())
+        consecutive = valid[1:] & valid[:-1]
+        if consecutive.any():
+            result['rr_rmssd'] = float(np.sqrt(np.mean(np.diff(rr)[consecutive] ** 2)))
+    beat = median_beat(window, samples, fs, r_peaks, np.diff(r_peaks))
+    if beat is None:
+        return result
+    ms = 1000.0 / fs
+    b = wave_boundaries(beat, fs)
+    for key in ('p_onset', 'p_offset', 'qrs_onset', 'qrs_offset', 't_offset'):
+        result[key] = None if b[key] is None else float(b[key]) * ms
+    result['p_present'] = b['p_present']
+    if result['qrs_onset'] is not None:
+        result['qrs'] = result['qrs_offset'] - result['qrs_onset']
+        if result['p_onset'] is not None:
+            result['pr'] = result['qrs_onset'] - result['p_onset']
+        if result['t_offset'] is not None:
+            result['qt'] = result['t_offset'] - result['qrs_onset']
+            if result['rr_mean'] is not None:
+                # Bazett formula, RR in seconds.
+                result['qtc'] = result['qt'] / math.sqrt(result['rr_mean'] / 1000.0)
+    return result
+
+
+def analyze(data, fs=contec.ECG90A_SAMPLE_RATE, leads=None):
+    """ Return the measurements of (leads x samples) data, missing values are numpy.nan """
+    # By default the acquired leads of a 12 leads ECG90A array are used.
+    data = np.asarray(data, dtype=np.float64)
+    if leads is None:
+        leads = ACQUIRED_LEADS if len(data) == len(contec.ECG90A_LEADS) else range(0, len(data))
+    data = data[list(leads)]
+    return analyze_window(lambda row0, row1: data[:, row0:row1], data.shape[1], fs)
+
+
+def analyze_ecg(ecg):
+    """ Return the measurements of an ecg_contec.ecg recording, None if its header is not valid """
+    if ecg.err & 0b00000011:
+        return None
+    window = lambda row0, row1: ecg.window(row0 / ecg.sample_rate, row1 / ecg.sample_rate, leads=ACQUIRED_LEADS)
+    result = analyze_window(window, ecg.samples, ecg.sample_rate)
+    result['err'] = ecg.err
+    return result
+
+
+def analyze_file(filename):
+    """ Return the measurements of an ECG90A or SCP-ECG file, with filename, err and elapsed time """
+    # ECG90A files are memory mapped and read one segment at a time.
+    t0 = time.perf_counter()
+    if ecg_catalog.file_format(filename) == ecg_catalog.FORMAT_SCP:
+        reader = scp.reader(filename)
+        result = analyze(reader.rhythm_data(), reader.sample_rate(), leads=range(0, reader.lead_definition()['leads_number']))
+        result['err'] = 0
+    else:
+        result = analyze_ecg(contec.ecg(filename, mmap=True))
+        if result is None:
+            return {'filename': filename, 'error': 'ECG file header did not parsed correctly', 'elapsed': time.perf_counter() - t0}
+    result.update({'filename': filename, 'error': None, 'elapsed': time.perf_counter() - t0})
+    return result
+
+
+def analyze_files(filenames, jobs=None):
+    """ Yield the analyze_file() results of many files, using jobs processes, in order of completion """
+    import concurrent.futures
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(analyze_file, filename): filename for filename in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {'filename': futures[future], 'error': str(e), 'elapsed': 0.0}
+
+
+def format_measurements(m):
+    """ Return the report header lines of the measurements """
+    value = lambda key, fmt: u'---' if m.get(key) is None else fmt % (m[key],)
+    return [
+        u'HR: %s bpm, RR: %s ms, SDNN: %s ms' % (value('heart_rate', u'%.0f'), value('rr_mean', u'%.0f'), value('rr_sdnn', u'%.0f')),
+        u'PR: %s ms, QRS: %s ms, QT/QTc: %s/%s ms' % (value('pr', u'%.0f'), value('qrs', u'%.0f'), value('qt', u'%.0f'), value('qtc', u'%.0f'))]
+
+
+def scp_section(m, stored_samples=None):
+    """ Return the SCP-ECG Section #7 (global measurements) data part of the measurements """
+    # Onsets and offsets are in ms from the start of the median beat,
+    # a single reference beat type (0) is used for all the QRS. Only
+    # the QRS into the stored_samples of Section #6 are listed, at
+    # most MAX_SCP_QRS (the count is a 16 bit field).
+    r_peaks = np.asarray(m.get('r_peaks', []))
+    if stored_samples is not None:
+        r_peaks = r_peaks[r_peaks < stored_samples]
+    qrs_count = min(len(r_peaks), MAX_SCP_QRS)
+    def ms(key, missing=scp.MEASURE_NOT_COMPUTED):
+        return missing if m.get(key) is None else int(round(m[key]))
+    p_missing = scp.MEASURE_NOT_COMPUTED if m.get('p_present') else scp.MEASURE_WAVE_NOT_PRESENT
+    if m.get('qrs_onset') is None:
+        p_missing = scp.MEASURE_NOT_COMPUTED
+    block = (ms('p_onset', p_missing), ms('p_offset', p_missing), ms('qrs_onset'), ms('qrs_offset'), ms('t_offset'), scp.AXIS_UNDEFINED, scp.AXIS_UNDEFINED, scp.AXIS_UNDEFINED)
+    return scp.make_global_measurements(
+        rr_interval=ms('rr_mean'),
+        blocks=[block],
+        qrs_types=[0] * qrs_count,
+        ventricular_rate=ms('heart_rate'),
+        qtc=ms('qtc'),
+        qtc_formula=scp.QTC_BAZETT if m.get('qtc') is not None else scp.QTC_UNKNOWN)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of decoded electrocardiogram data.
+
+Entries are NumPy .npz files holding the decoded arrays and a JSON
+dictionary of parsed header fields. They are keyed by the SHA-1 of
+the input file contents, plus the kind of parser and its version,
+so a modified file or a new parser never reads stale data. The
+least recently used entries are removed when the cache grows over
+its size limit.
+
+Required Python packages: python3-numpy
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__author__ = "Niccolo Rigacci"
+__copyright__ = "Copyright 2020 Niccolo Rigacci <niccolo@rigacci.org>"
+__license__ = "GPLv3-or-later"
+__email__ = "niccolo@rigacci.org"
+__version__ = "0.1.0"
+
+# Cache directory, can be changed with the ECG_CACHE_DIR environment variable.
+CACHE_DIR = os.environ.get('ECG_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ecg-contec'))
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Content hashes of already seen files, keyed by path, size and mtime.
+INDEX_FILE = 'index.json'
+
+
+class cache():
+    """ Size-bounded LRU cache of decoded arrays, stored into a directory """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = CACHE_DIR if directory is None else directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+
+
+    def index(self):
+        if self._index is None:
+            self._index = self.read_index()
+        return self._index
+
+
+    def known_hash(self, filename):
+        """ Return the SHA-1 of the file contents if already known, None otherwise """
+        # Files are identified by absolute path, size and mtime;
+        # if one of them changed the contents must be hashed again.
+        st = os.stat(filename)
+        entry = self.index().get(os.path.abspath(filename))
+        if isinstance(entry, list) and len(entry) == 3 and entry[0:2] == [st.st_size, st.st_mtime_ns]:
+            return entry[2]
+        return None
+
+
+    def content_hash(self, filename):
+        """ Return the SHA-1 of the file contents, hashing it only if it changed """
+        known = self.known_hash(filename)
+        if known is not None:
+            return known
+        st = os.stat(filename)
+        path = os.path.abspath(filename)
+        stamp = [st.st_size, st.st_mtime_ns]
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        self.index()[path] = stamp + [h.hexdigest()]
+        self.write_index(path)
+        return h.hexdigest()
+
+
+    def read_index(self):
+        """ Return the index stored on disk, an empty one if missing or corrupt """
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return index if isinstance(index, dict) else {}
+
+
+    def write_index(self, path):
+        """ Store the entry of path into the index on disk """
+        # Other processes may share the directory: the index is read
+        # again and updated while holding a lock, then atomically
+        # replaced. A corrupt index is rebuilt.
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            name = os.path.join(self.directory, INDEX_FILE)
+            with open(name + u'.lock', 'w') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                index = self.read_index()
+                index[path] = self._index[path]
+                tmp_name = u'%s.%d.tmp' % (name, os.getpid())
+                with open(tmp_name, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_name, name)
+            self._index = index
+        except OSError as e:
+            logging.warning(u'Cannot write cache index: %s' % (e,))
+
+
+    def key(self, filename, kind, version):
+        """ Return the cache key of a file decoded by parser kind, version """
+        return u'%s-%s-%s' % (kind, version, self.content_hash(filename))
+
+
+    def cached_key(self, filename, kind, version):
+        """ Return the cache key if the file is already cached, None otherwise, without hashing it """
+        known = self.known_hash(filename)
+        if known is None:
+            return None
+        key = u'%s-%s-%s' % (kind, version, known)
+        return key if os.path.exists(self.entry_filename(key)) else None
+
+
+    def entry_filename(self, key):
+        return os.path.join(self.directory, key + u'.npz')
+
+
+    def get(self, key):
+        """ Return (meta, arrays) stored with key, None if not cached """
+        name = self.entry_filename(key)
+        try:
+            with np.load(name, allow_pickle=False) as npz:
+                arrays = dict((k, npz[k]) for k in npz.files if k != 'meta')
+                meta = json.loads(str(npz['meta']))
+            # The entry modification time is the last use, for LRU eviction.
+            os.utime(name)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (meta, arrays)
+
+
+    def put(self, key, meta, arrays):
+        """ Store a dictionary of arrays and a JSON serializable dictionary """
+        name = self.entry_filename(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_name = u'%s.%d.tmp' % (name, os.getpid())
+            with open(tmp_name, 'wb') as f:
+                np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+            os.replace(tmp_name, name)
+        except OSError as e:
+            logging.warning(u'Cannot write cache entry: %s' % (e,))
+            return
+        self.evict()
+
+
+    def evict(self):
+        """ Remove the least recently used entries, until the cache fits max_bytes """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                pass
+
+
+    def clear(self):
+        """ Remove all the entries and the index """
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz') or name in (INDEX_FILE, INDEX_FILE + u'.lock'):
+                os.remove(os.path.join(self.directory, name))
+        self._index = None
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of ECG90A and SCP-ECG recordings, stored into a SQLite database.
+
+Directory trees are scanned incrementally: only new files and files
+whose size or modification time changed are parsed, the rows of
+deleted files are removed. Only the file headers are read (the
+Section #1 tags for SCP-ECG files), not the rhythm data.
+
+Required custom modules: ecg_contec.py, ecg_scp.py
+"""
+
+import ecg_contec as contec
+import ecg_scp as scp
+import os
+import os.path
+import sqlite3
+
+__author__ = "Niccolo Rigacci"
+__copyright__ = "Copyright 2020 Niccolo Rigacci <niccolo@rigacci.org>"
+__license__ = "GPLv3-or-later"
+__email__ = "niccolo@rigacci.org"
+__version__ = "0.1.0"
+
+# Catalog database, can be changed with the ECG_CATALOG environment variable.
+DEFAULT_CATALOG = os.environ.get('ECG_CATALOG', os.path.join(os.path.expanduser('~'), '.local', 'share', 'ecg-contec', 'catalog.sqlite'))
+FORMAT_CONTEC = 'ecg'
+FORMAT_SCP = 'scp'
+# Error flag for SCP-ECG files which cannot be parsed.
+ERR_SCP_PARSE = 0b00000001
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recordings (
+    path TEXT PRIMARY KEY,
+    format TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    case_id TEXT,
+    timestamp TEXT,
+    patient_name TEXT,
+    patient_sex INTEGER,
+    patient_age INTEGER,
+    patient_weight INTEGER,
+    duration REAL,
+    samples INTEGER,
+    sample_rate REAL,
+    err INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS recordings_patient ON recordings (patient_name);
+CREATE INDEX IF NOT EXISTS recordings_timestamp ON recordings (timestamp);
+CREATE INDEX IF NOT EXISTS recordings_case ON recordings (case_id);
+CREATE TABLE IF NOT EXISTS scp_tags (
+    path TEXT NOT NULL REFERENCES recordings (path) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    tag INTEGER NOT NULL,
+    label TEXT,
+    value TEXT,
+    PRIMARY KEY (path, seq)
+);
+'''
+COLUMNS = ['path', 'format', 'size', 'mtime_ns', 'case_id', 'timestamp', 'patient_name', 'patient_sex', 'patient_age', 'patient_weight', 'duration', 'samples', 'sample_rate', 'err']
+# Mapping from SCP-ECG sex labels to ECG90A codes.
+SCP_SEX = {scp.SEX[scp.SEX_MALE]: contec.SEX_MALE, scp.SEX[scp.SEX_FEMALE]: contec.SEX_FEMALE}
+
+
+def file_format(filename):
+    """ Return the format of a file from its extension, None if not a recording """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.ecg':
+        return FORMAT_CONTEC
+    if ext == '.scp':
+        return FORMAT_SCP
+    return None
+
+
+def value_unit(text, unit):
+    """ Return the integer value of a "<value> <unit>" SCP-ECG field, 0 if other units """
+    parts = text.split(' ') if isinstance(text, str) else []
+    if len(parts) == 2 and parts[1] == unit and parts[0].isdigit():
+        return int(parts[0])
+    return 0
+
+
+def contec_row(filename):
+    """ Return the catalog fields of an ECG90A file """
+    ecg = contec.ecg(filename)
+    row = {'err': ecg.err}
+    if getattr(ecg, 'case', None) is not None:
+        row.update({
+            'case_id': ecg.case,
+            'timestamp': ecg.timestamp,
+            'patient_name': ecg.patient_name,
+            'patient_sex': ecg.patient_sex,
+            'patient_age': ecg.patient_age,
+            'patient_weight': ecg.patient_weight,
+            'duration': ecg.duration,
+            'samples': ecg.samples,
+            'sample_rate': ecg.sample_rate})
+    return (row, [])
+
+
+def scp_row(filename):
+    """ Return the catalog fields and the Section #1 tags of an SCP-ECG file """
+    try:
+        record = scp.reader(filename)
+        params = record.patient_data()
+        lead_def = record.lead_definition() if record.has_section(3) else None
+        sample_rate = record.sample_rate() if (lead_def is not None and record.has_section(6)) else None
+    except (scp.scp_error, UnicodeDecodeError):
+        return ({'err': ERR_SCP_PARSE}, [])
+    tags = {}
+    for tag, label, length, value in params:
+        if tag not in tags:
+            tags[tag] = value
+    name = u' '.join(tags[t] for t in (scp.TAG_PATIENT_FIRST_NAME, scp.TAG_PATIENT_LAST_NAME) if tags.get(t))
+    timestamp = None
+    if scp.TAG_DATE_ACQ in tags:
+        timestamp = u'%s %s' % (tags[scp.TAG_DATE_ACQ], tags.get(scp.TAG_TIME_ACQ, u'00:00:00'))
+    row = {
+        'case_id': tags.get(scp.TAG_ECG_SEQ_NUM) or tags.get(scp.TAG_PATIENT_ID),
+        'timestamp': timestamp,
+        'patient_name': name,
+        'patient_sex': SCP_SEX.get(tags.get(scp.TAG_PATIENT_SEX), contec.SEX_UNKNOWN),
+        'patient_age': value_unit(tags.get(scp.TAG_PATIENT_AGE), scp.AGE[scp.AGE_YEARS]),
+        'patient_weight': value_unit(tags.get(scp.TAG_PATIENT_WEIGHT), scp.WEIGHT[scp.WEIGHT_KILOGRAM]),
+        'err': 0}
+    if lead_def is not None and sample_rate is not None:
+        row['samples'] = lead_def['max_sample_num']
+        row['sample_rate'] = sample_rate
+        row['duration'] = lead_def['max_sample_num'] / sample_rate
+    tag_rows = []
+    for seq, (tag, label, length, value) in enumerate(params):
+        if tag == scp.TAG_EOF:
+            continue
+        tag_rows.append((seq, tag, label, value.hex() if isinstance(value, bytes) else str(value)))
+    return (row, tag_rows)
+
+
+class catalog():
+    """ SQLite index of the recordings headers """
+
+    def __init__(self, filename=DEFAULT_CATALOG):
+        if os.path.dirname(filename) != '':
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+
+    def close(self):
+        self.db.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def scan(self, paths):
+        """ Index files and directory trees, return counts of (parsed, unchanged, removed) files """
+        parsed, unchanged, removed = 0, 0, 0
+        with self.db:
+            for root in paths:
+                root = os.path.abspath(root)
+                found = {}
+                if os.path.isdir(root):
+                    for directory, subdirs, files in os.walk(root):
+                        for name in files:
+                            if file_format(name) is not None:
+                                found[os.path.join(directory, name)] = None
+                elif os.path.isfile(root) and file_format(root) is not None:
+                    found[root] = None
+                # Compare with the rows already indexed under root.
+                known = {}
+                for r in self.db.execute('SELECT path, size, mtime_ns FROM recordings WHERE path = ? OR path LIKE ? ESCAPE ?', (root, like_prefix(root), '\\')):
+                    known[r['path']] = (r['size'], r['mtime_ns'])
+                for path in sorted(found):
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if known.get(path) == (st.st_size, st.st_mtime_ns):
+                        unchanged += 1
+                        continue
+                    self.add(path, st)
+                    parsed += 1
+                for path in known:
+                    if path not in found:
+                        self.db.execute('DELETE FROM recordings WHERE path = ?', (path,))
+                        removed += 1
+        return (parsed, unchanged, removed)
+
+
+    def add(self, path, st=None):
+        """ Parse a file and store (or replace) its row """
+        if st is None:
+            st = os.stat(path)
+        fmt = file_format(path)
+        row, tags = contec_row(path) if fmt == FORMAT_CONTEC else scp_row(path)
+        row.update({'path': path, 'format': fmt, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns})
+        self.db.execute('DELETE FROM recordings WHERE path = ?', (path,))
+        self.db.execute('INSERT INTO recordings (%s) VALUES (%s)' % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), [row.get(c) for c in COLUMNS])
+        self.db.executemany('INSERT INTO scp_tags (path, seq, tag, label, value) VALUES (?, ?, ?, ?, ?)', [(path,) + t for t in tags])
+
+
+    def find(self, patient=None, case=None, since=None, until=None, sex=None, fmt=None, path=None, limit=None):
+        """ Return the rows (as dictionaries) matching all the given conditions, sorted by timestamp """
+        # patient and case match substrings, ignoring case; since and
+        # until are "YYYY-MM-DD[ HH:MM:SS]" strings or datetime objects.
+        where, args = [], []
+        if patient is not None:
+            where.append('patient_name LIKE ? ESCAPE ?')
+            args += ['%' + like_escape(patient) + '%', '\\']
+        if case is not None:
+            where.append('case_id LIKE ? ESCAPE ?')
+            args += ['%' + like_escape(case) + '%', '\\']
+        if since is not None:
+            where.append('timestamp >= ?')
+            args.append(str(since))
+        if until is not None:
+            # A date alone includes the whole day.
+            until = str(until)
+            where.append('timestamp <= ?')
+            args.append(until + ' 23:59:59' if len(until) == 10 else until)
+        if sex is not None:
+            where.append('patient_sex = ?')
+            args.append(sex)
+        if fmt is not None:
+            where.append('format = ?')
+            args.append(fmt)
+        if path is not None:
+            where.append('(path = ? OR path LIKE ? ESCAPE ?)')
+            args += [os.path.abspath(path), like_prefix(os.path.abspath(path)), '\\']
+        sql = 'SELECT * FROM recordings'
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY timestamp, path'
+        if limit is not None:
+            sql += ' LIMIT %d' % (int(limit),)
+        return [dict(r) for r in self.db.execute(sql, args)]
+
+
+    def tags(self, path):
+        """ Return the SCP-ECG Section #1 tags of a file, as a list of (tag, label, value) """
+        return [tuple(r) for r in self.db.execute('SELECT tag, label, value FROM scp_tags WHERE path = ? ORDER BY seq', (os.path.abspath(path),))]
+
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM recordings').fetchone()[0]
+
+
+def like_escape(text):
+    """ Escape the LIKE wildcards into text """
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def like_prefix(directory):
+    """ Return the LIKE pattern matching all the paths below directory """
+    return like_escape(os.path.join(directory, '')) + '%'
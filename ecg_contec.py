@@ -5,14 +5,21 @@ Parses ECG files produced by the Contec ECG90A electrocardiograph.
 Can export in CSV or SCP-ECG format.
 """
 
+import ecg_metrics as metrics
 import ecg_scp as scp
 
 import binascii
 import datetime
+import gzip
+import json
 import logging
+import math
 import os.path
 import struct
 import sys
+import time
+import zipfile
+import numpy as np
 
 __author__ = "Niccolo Rigacci"
 __copyright__ = "Copyright 2019-2020 Niccolo Rigacci <niccolo@rigacci.org>"
@@ -58,11 +65,47 @@ ECG90A_LEADS_SCP = {
 
 # How many columns to include into CSV exported files.
 DEFAULT_CSV_COLUMNS = len(ECG90A_LEADS)
+# Rows read at once by ecg.chunks().
+DEFAULT_CHUNK_ROWS = 8192
+# Version of the decoded data stored into ecg_cache, change it if decoding changes.
+CACHE_VERSION = '1'
+# On a cache miss, ecg.window() decodes and caches the whole recording
+# if its payload is not larger than this, otherwise only the window.
+CACHE_WHOLE_MAX_BYTES = 32 * 1024 * 1024
+# Format identifier stored into columnar (.npz) files.
+COLUMNAR_FORMAT = 'ecg_contec-columnar-1'
+# Duration (in seconds) of each EDF data record, and how many records to write at once.
+DEFAULT_EDF_RECORD_DURATION = 1.0
+EDF_RECORDS_PER_WRITE = 64
+# Seconds between size checks of a growing file, and without growth before it is complete.
+DEFAULT_FOLLOW_POLL = 0.5
+DEFAULT_FOLLOW_IDLE = 10.0
+
+
+def edf_time(seconds):
+    """ Return the time as a string for EDF+ Time-stamped Annotations Lists """
+    text = ('%.6f' % (seconds,)).rstrip('0').rstrip('.')
+    return text if text.startswith('-') else '+' + text
+
+
+def edf_annotation_records(annotations, records, record_duration):
+    """ Return the EDF+ Time-stamped Annotations Lists (TALs) for each data record, as bytes """
+    # Each record begins with the time-keeping TAL, which holds the
+    # record onset; each annotation goes into the record containing
+    # its onset. The returned byte strings have even length.
+    tals = [bytes(edf_time(r * record_duration) + '\x14\x14\x00', 'ascii') for r in range(0, records)]
+    for onset, duration, text in annotations:
+        r = min(max(0, int(onset / record_duration)), records - 1)
+        tal = edf_time(onset)
+        if duration is not None:
+            tal += '\x15' + edf_time(duration)[1:]
+        tal += '\x14' + text.replace('\x14', ' ').replace('\x15', ' ') + '\x14\x00'
+        tals[r] += bytes(tal, 'utf-8')
+    return [tal + b'\x00' if len(tal) % 2 else tal for tal in tals]
 
 class ecg():
 
-    def __init__(self, filename, sample_rate=ECG90A_SAMPLE_RATE, data_series=ECG90A_DATA_SERIES, sample_bits=ECG90A_SAMPLE_BITS):
-        logging.basicConfig(format='%(levelname)s: ecg_contec: %(message)s', level=logging.DEBUG)
+    def __init__(self, filename, sample_rate=ECG90A_SAMPLE_RATE, data_series=ECG90A_DATA_SERIES, sample_bits=ECG90A_SAMPLE_BITS, mmap=False, cache=None):
         self.err = 0
         if not os.path.exists(filename):
             logging.error(u'Input file %s does not exists' % (filename,))
@@ -76,6 +119,9 @@ class ecg():
         self.sample_rate = sample_rate
         self.data_series = data_series
         self.sample_bits = sample_bits
+        self.mmap = mmap
+        # An ecg_cache.cache object, where decoded data is stored.
+        self.cache = cache
         # Get some metadata from file size.
         self.file_size = os.path.getsize(filename)
         self.file_timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(filename))
@@ -89,23 +135,30 @@ class ecg():
         self.duration = float(self.samples / self.sample_rate)
         # Read and parse the file header.
         try:
-            with open(filename, 'rb') as f:
-                self.case = self.asciiz(f.read(8))
-                self.unknown1 = f.read(2)
-                self.timestamp = self.asciiz(f.read(20))
-                self.unknown2 = f.read(2)
-                self.patient_name = self.asciiz(f.read(8))
-                self.patient_sex = int.from_bytes(f.read(1), byteorder='little')  # 0: F, 1: M, 255: Blank
-                self.patient_age = int.from_bytes(f.read(1), byteorder='little')  # Max is 200.
-                self.patient_weight = int.from_bytes(f.read(1), byteorder='little')
-                if self.patient_sex in SEX_LABELS:
-                    self.patient_sex_label = SEX_LABELS[self.patient_sex]
-                else:
-                    self.patient_sex_label = 'Unknown code %s' % (self.patient_sex,)
+            with metrics.stage(metrics.STAGE_HEADER), open(filename, 'rb') as f:
+                self.read_header(f)
         except:
             logging.error(u'Error reading file header')
             self.err |= 0b00000010
             return None
+        metrics.count(metrics.BYTES_READ, HEADER_LEN)
+        metrics.set_flags(metrics.ERR, self.err)
+
+
+    def read_header(self, f):
+        """ Read and parse the file header from a binary stream """
+        self.case = self.asciiz(f.read(8))
+        self.unknown1 = f.read(2)
+        self.timestamp = self.asciiz(f.read(20))
+        self.unknown2 = f.read(2)
+        self.patient_name = self.asciiz(f.read(8))
+        self.patient_sex = int.from_bytes(f.read(1), byteorder='little')  # 0: F, 1: M, 255: Blank
+        self.patient_age = int.from_bytes(f.read(1), byteorder='little')  # Max is 200.
+        self.patient_weight = int.from_bytes(f.read(1), byteorder='little')
+        if self.patient_sex in SEX_LABELS:
+            self.patient_sex_label = SEX_LABELS[self.patient_sex]
+        else:
+            self.patient_sex_label = 'Unknown code %s' % (self.patient_sex,)
         try:
             t = datetime.datetime.strptime(self.timestamp, ECG90A_DATETIME_FORMAT)
         except:
@@ -178,16 +231,242 @@ class ecg():
             read_rows += 1
             yield ecg_row[0:cols]
         f_in.close()
+        metrics.count(metrics.BYTES_READ, read_rows * self.data_series * bytes_per_sample)
+        metrics.count(metrics.SAMPLES_DECODED, read_rows)
+        metrics.set_flags(metrics.ERR, self.err)
+
+
+    def read_payload(self):
+        """ Return the raw payload as an array of (samples x data_series) unsigned values """
+        # The whole payload is read at once and cached; a row with
+        # all-zeros terminates the data, any following row is discarded.
+        # In mmap mode the array is a read-only view over the file bytes,
+        # pages are read only when accessed and no terminator is searched:
+        # whole recording readers use full_payload().
+        if getattr(self, '_payload', None) is not None:
+            return self._payload
+        dtype = np.dtype('<u%d' % (int(self.sample_bits / 8),))
+        if self.mmap:
+            self._payload = np.memmap(self.filename, dtype=dtype, mode='r', offset=HEADER_LEN, shape=(self.samples, self.data_series))
+            return self._payload
+        with metrics.stage(metrics.STAGE_READ), open(self.filename, 'rb') as f_in:
+            f_in.seek(HEADER_LEN)
+            payload = np.fromfile(f_in, dtype=dtype, count=self.samples * self.data_series)
+        metrics.count(metrics.BYTES_READ, payload.nbytes)
+        rows = int(len(payload) / self.data_series)
+        if rows < self.samples:
+            logging.warning(u'Unexpected EOF: rows read: %d, expected: %d, unused values: %s' % (rows, self.samples, len(payload) % self.data_series))
+            self.err |= 0b00001100
+        payload = payload[0:rows * self.data_series].reshape((rows, self.data_series))
+        self._payload = self.cut_at_terminator(payload)
+        return self._payload
+
+
+    def full_payload(self):
+        """ Return read_payload() up to the terminator, also in mmap mode """
+        # In mmap mode the whole file is scanned once for the terminator.
+        if not self.mmap:
+            return self.read_payload()
+        if getattr(self, '_full_payload', None) is None:
+            self._full_payload = self.cut_at_terminator(self.read_payload())
+        return self._full_payload
+
+
+    def cut_at_terminator(self, payload, first_row=0):
+        """ Return the payload rows preceding the first all-zeros row """
+        terminators = np.flatnonzero(~payload.any(axis=1))
+        if len(terminators) > 0:
+            rows = int(terminators[0])
+            logging.warning(u'Unexpected end of data: found an all-zeros row, only %d read so far, expected %d' % (first_row + rows, self.samples))
+            self.err |= 0b00001100
+            payload = payload[0:rows]
+        return payload
+
+
+    def lead_values(self, payload, leads, xoffset=ECG90A_XOFFSET):
+        """ Return a (len(leads) x rows) array calculated from raw payload rows """
+        with metrics.stage(metrics.STAGE_DECODE):
+            data = np.empty((len(leads), len(payload)))
+            series = {}
+            def serie(k):
+                if k not in series:
+                    raw = payload[:, k]
+                    series[k] = raw.astype(np.float64) + xoffset
+                    series[k][raw == NULL_VALUE] = np.nan
+                return series[k]
+            for j, lead in enumerate(leads):
+                if self.data_series < 2:
+                    data[j] = serie(lead)
+                elif lead >= 6:
+                    data[j] = serie(lead - 4)
+                # Assume that the first two data series are lead II and lead III,
+                # so calculate I, avR, avL and avF using the Einthoven formulas.
+                # A NaN in lead II or lead III propagates to the derived leads.
+                elif lead == 0:
+                    data[j] = serie(0) - serie(1)
+                elif lead == 1:
+                    data[j] = serie(0)
+                elif lead == 2:
+                    data[j] = serie(1)
+                elif lead == 3:
+                    data[j] = np.trunc(serie(1) / 2) - serie(0)
+                elif lead == 4:
+                    data[j] = np.trunc(serie(0) / 2) - serie(1)
+                elif lead == 5:
+                    data[j] = np.trunc((serie(0) + serie(1)) / 2)
+            # Adding zero turns any negative zero from trunc() into a plain zero.
+            data += 0.0
+        if metrics.enabled():
+            metrics.count(metrics.SAMPLES_DECODED, len(payload))
+            metrics.count(metrics.NULL_VALUES, np.count_nonzero(payload == NULL_VALUE))
+            metrics.set_flags(metrics.ERR, self.err)
+        return data
+
+
+    def leads_count(self):
+        """ Return the number of leads available from the data series """
+        return self.data_series if self.data_series < 2 else self.data_series + 4
+
+
+    def decoded(self, xoffset=ECG90A_XOFFSET):
+        """ Return (int16 values, packed missing mask) of all the leads, using self.cache """
+        if getattr(self, '_decoded', None) is None:
+            self._decoded = {}
+        if xoffset not in self._decoded:
+            key = self.cache.key(self.filename, u'contec', u'%s%+d' % (CACHE_VERSION, xoffset))
+            entry = self.cache.get(key)
+            if entry is not None:
+                meta, arrays = entry
+                self.err |= meta['err']
+                self._decoded[xoffset] = (arrays['values'], arrays['null'])
+            else:
+                data = self.lead_values(self.full_payload(), range(0, self.leads_count()), xoffset=xoffset)
+                missing = np.isnan(data)
+                values = np.where(missing, 0, data).astype(np.int16)
+                null = np.packbits(missing, axis=1)
+                header = dict((k, getattr(self, k)) for k in ('case', 'timestamp', 'patient_name', 'patient_sex', 'patient_age', 'patient_weight', 'sample_rate'))
+                self.cache.put(key, {'err': self.err, 'header': header}, {'values': values, 'null': null})
+                self._decoded[xoffset] = (values, null)
+        return self._decoded[xoffset]
+
+
+    def is_cached(self, xoffset=ECG90A_XOFFSET):
+        """ Return True if decoded() data is available without decoding, nor hashing the file """
+        if xoffset in (getattr(self, '_decoded', None) or {}):
+            return True
+        return self.cache.cached_key(self.filename, u'contec', u'%s%+d' % (CACHE_VERSION, xoffset)) is not None
+
+
+    def decoded_values(self, leads, row0=0, row1=None, xoffset=ECG90A_XOFFSET):
+        """ Return rows row0:row1 of leads from decoded(), as float64 with numpy.nan """
+        values, null = self.decoded(xoffset)
+        row1 = values.shape[1] if row1 is None else min(row1, values.shape[1])
+        row0 = min(row0, row1)
+        data = np.empty((len(leads), row1 - row0), dtype=np.float64)
+        for j, lead in enumerate(leads):
+            data[j] = values[lead, row0:row1]
+            data[j][np.unpackbits(null[lead], count=values.shape[1])[row0:row1].astype(bool)] = np.nan
+        return data
+
+
+    def to_array(self, xoffset=ECG90A_XOFFSET, cols=DEFAULT_CSV_COLUMNS):
+        """ Return data as a (cols x samples) array, missing values are numpy.nan """
+        # The array is cached and shared by all the exporters, so it is read-only.
+        if getattr(self, '_arrays', None) is None:
+            self._arrays = {}
+        if (xoffset, cols) not in self._arrays:
+            leads = range(0, min(cols, self.leads_count()))
+            if self.cache is not None:
+                data = self.decoded_values(leads, xoffset=xoffset)
+            else:
+                data = self.lead_values(self.full_payload(), leads, xoffset=xoffset)
+            data.flags.writeable = False
+            self._arrays[(xoffset, cols)] = data
+        return self._arrays[(xoffset, cols)]
+
+
+    def recording(self, xoffset=ECG90A_XOFFSET):
+        """ Return the data series into a compact recording container """
+        payload = self.full_payload()
+        null_mask = (payload == NULL_VALUE).T
+        series = payload.T.astype(np.int16)
+        series += xoffset
+        series[null_mask] = 0
+        return recording(series, np.packbits(null_mask, axis=1), self.sample_rate)
+
+
+    def filtered_array(self, filters=None, xoffset=ECG90A_XOFFSET, cols=DEFAULT_CSV_COLUMNS):
+        """ Return to_array() data passed through an ecg_filter.filter_chain, rounded to integer values """
+        data = self.to_array(xoffset=xoffset, cols=cols)
+        if filters is None:
+            return data
+        # Adding zero turns any negative zero from round() into a plain zero.
+        return np.round(filters.apply(data)) + 0.0
 
 
-    def export_csv(self, filename=None, overwrite=False, as_millivolt=False, none_as_zero=False, xoffset=ECG90A_XOFFSET, cols=DEFAULT_CSV_COLUMNS):
+    def window(self, t0, t1=None, leads=None, xoffset=ECG90A_XOFFSET):
+        """ Return data from t0 to t1 (seconds) as a (leads x samples) array """
+        # Only the requested rows and leads are calculated; in mmap mode
+        # only the file pages containing the time window are read. With
+        # a cache, rows are taken from the cached decoded data; on a
+        # cache miss the recording is decoded and cached if it is not
+        # larger than CACHE_WHOLE_MAX_BYTES or if the window covers it
+        # all, so large files are not hashed and decoded for a window.
+        if leads is None:
+            leads = range(0, self.leads_count())
+        if self.cache is not None:
+            row0 = max(0, int(round(t0 * self.sample_rate)))
+            row1 = None if t1 is None else max(row0, int(round(t1 * self.sample_rate)))
+            whole = self.payload_len <= CACHE_WHOLE_MAX_BYTES or (row0 == 0 and (row1 is None or row1 >= self.samples))
+            if whole or self.is_cached(xoffset):
+                return self.decoded_values(leads, row0, row1, xoffset=xoffset)
+        payload = self.read_payload()
+        row0 = min(max(0, int(round(t0 * self.sample_rate))), len(payload))
+        row1 = len(payload) if t1 is None else min(max(row0, int(round(t1 * self.sample_rate))), len(payload))
+        rows = payload[row0:row1]
+        if self.mmap:
+            rows = self.cut_at_terminator(rows, first_row=row0)
+        return self.lead_values(rows, leads, xoffset=xoffset)
+
+
+    def chunks(self, rows=DEFAULT_CHUNK_ROWS, leads=None, xoffset=ECG90A_XOFFSET):
+        """ Yield data as (leads x rows) arrays, reading the file one chunk at a time """
+        # Memory usage does not depend on the recording length: the
+        # payload is neither cached nor read at once.
+        if leads is None:
+            leads = range(0, self.leads_count())
+        dtype = np.dtype('<u%d' % (int(self.sample_bits / 8),))
+        with open(self.filename, 'rb') as f_in:
+            f_in.seek(HEADER_LEN)
+            read_rows = 0
+            while read_rows < self.samples:
+                count = min(rows, self.samples - read_rows)
+                payload = np.fromfile(f_in, dtype=dtype, count=count * self.data_series)
+                metrics.count(metrics.BYTES_READ, payload.nbytes)
+                n = int(len(payload) / self.data_series)
+                if n < count:
+                    logging.warning(u'Unexpected EOF: rows read: %d, expected: %d, unused values: %s' % (read_rows + n, self.samples, len(payload) % self.data_series))
+                    self.err |= 0b00001100
+                payload = payload[0:n * self.data_series].reshape((n, self.data_series))
+                chunk = self.cut_at_terminator(payload, first_row=read_rows)
+                if len(chunk) > 0:
+                    yield self.lead_values(chunk, leads, xoffset=xoffset)
+                if len(chunk) < count:
+                    break
+                read_rows += n
+
+
+    def export_csv(self, filename=None, overwrite=False, as_millivolt=False, none_as_zero=False, xoffset=ECG90A_XOFFSET, cols=DEFAULT_CSV_COLUMNS, filters=None, header=False, time_column=False, compress=False):
         """ Export ECG data into a CSV format file """
+        # Optional header row with the lead names, time column (in
+        # seconds) and gzip compression (default filename ends with
+        # ".csv.gz"). Rows are formatted and written in blocks.
 
         if self.err != 0:
             logging.warning(u'ECG file header did not parsed correctly')
             return None
         if filename is None:
-            filename_csv = self.filename + u'.csv'
+            filename_csv = self.filename + (u'.csv.gz' if compress else u'.csv')
         else:
             filename_csv = filename
         if os.path.exists(filename_csv) and not overwrite:
@@ -195,16 +474,73 @@ class ecg():
             self.err |= 0b00010000
             return None
         amplitude_mult = float(ECG90A_AMPL_NANOVOLT) / 1000000.0
-        with open(filename_csv, 'w') as f:
-            for row in self.readline(xoffset=xoffset, cols=cols):
-                if as_millivolt:
-                    f.write(','.join(scp.csv_format(x, multiplier=amplitude_mult, none_as_zero=none_as_zero) for x in row) + '\n')
-                else:
-                    f.write(','.join(scp.csv_format(x, num_format=u'%d', none_as_zero=none_as_zero) for x in row) + '\n')
+        data = self.filtered_array(filters, xoffset=xoffset, cols=cols)
+        labels = ([u'Time'] if time_column else []) + ECG90A_LEADS[0:len(data)]
+        if as_millivolt:
+            options = {'multiplier': amplitude_mult}
+        else:
+            options = {'num_format': u'%d'}
+        with metrics.stage(metrics.STAGE_WRITE):
+            if compress:
+                f = gzip.open(filename_csv, 'wt', newline='')
+            else:
+                f = open(filename_csv, 'w')
+            with f:
+                scp.write_csv(f, data, none_as_zero=none_as_zero, header=[labels] if header else None, sample_rate=self.sample_rate if time_column else None, **options)
+        metrics.count(metrics.BYTES_WRITTEN, os.path.getsize(filename_csv))
         return filename_csv
 
 
-    def export_edf(self, filename=None, overwrite=False, as_millivolt=False, none_as_zero=False, xoffset=ECG90A_XOFFSET, cols=DEFAULT_CSV_COLUMNS):
+    def export_columnar(self, filename=None, overwrite=False, xoffset=ECG90A_XOFFSET, cols=DEFAULT_CSV_COLUMNS, filters=None, compress=True):
+        """ Export ECG data into a NumPy .npz file, with one int16 array per lead """
+        # Missing values are stored as zero, with a boolean mask named
+        # "null_<lead>" if the lead has any. Header data is stored as a
+        # JSON string into the "meta" array. Uncompressed files can be
+        # memory-mapped by the columnar loader.
+
+        if self.err != 0:
+            logging.warning(u'ECG file header did not parsed correctly')
+            return None
+        if filename is None:
+            filename_npz = self.filename + u'.npz'
+        else:
+            filename_npz = filename
+        if os.path.exists(filename_npz) and not overwrite:
+            logging.warning(u'Output file "%s" already exists, will not overwrite.' % (filename_npz,))
+            self.err |= 0b00010000
+            return None
+        data = self.filtered_array(filters, xoffset=xoffset, cols=cols)
+        meta = {
+            'format': COLUMNAR_FORMAT,
+            'filename': os.path.basename(self.filename),
+            'case': self.case,
+            'timestamp': self.timestamp,
+            'patient_name': self.patient_name,
+            'patient_sex': self.patient_sex,
+            'patient_age': self.patient_age,
+            'patient_weight': self.patient_weight,
+            'sample_rate': self.sample_rate,
+            'samples': int(data.shape[1]),
+            'amplitude_nanovolt': ECG90A_AMPL_NANOVOLT,
+            'xoffset': xoffset,
+            'leads': ECG90A_LEADS[0:len(data)]}
+        arrays = {'meta': np.array(json.dumps(meta))}
+        for i, lead in enumerate(meta['leads']):
+            missing = np.isnan(data[i])
+            arrays[lead] = np.where(missing, 0, data[i]).astype('<i2')
+            if missing.any():
+                arrays['null_' + lead] = missing
+        # Write to a file object, so that numpy does not append ".npz" to the name.
+        with metrics.stage(metrics.STAGE_WRITE), open(filename_npz, 'wb') as f:
+            if compress:
+                np.savez_compressed(f, **arrays)
+            else:
+                np.savez(f, **arrays)
+        metrics.count(metrics.BYTES_WRITTEN, os.path.getsize(filename_npz))
+        return filename_npz
+
+
+    def export_edf(self, filename=None, overwrite=False, as_millivolt=False, none_as_zero=False, xoffset=ECG90A_XOFFSET, cols=DEFAULT_CSV_COLUMNS, filters=None, record_duration=DEFAULT_EDF_RECORD_DURATION, annotations=None):
         """ Export ECG data into a EDF format file """
 
         if self.err != 0:
@@ -218,11 +554,33 @@ class ecg():
             logging.warning(u'Output file "%s" already exists, will not overwrite.' % (filename_edf,))
             self.err |= 0b00010000
             return None
+        with open(filename_edf, 'wb') as f:
+            self.write_edf(f, xoffset=xoffset, cols=cols, filters=filters, record_duration=record_duration, annotations=annotations)
+        metrics.count(metrics.BYTES_WRITTEN, os.path.getsize(filename_edf))
+        return filename_edf
+
+
+    def write_edf(self, f, xoffset=ECG90A_XOFFSET, cols=DEFAULT_CSV_COLUMNS, filters=None, record_duration=DEFAULT_EDF_RECORD_DURATION, annotations=None):
+        """ Write ECG data in EDF format into an open binary stream """
+        # Each data record contains record_duration seconds of all the
+        # signals; the last record is padded with zeros. If annotations
+        # is a list of (onset, duration, text) tuples (seconds, duration
+        # can be None), an EDF+C file is written, with an additional
+        # "EDF Annotations" signal.
         t = datetime.datetime.strptime(self.timestamp, ECG90A_DATETIME_FORMAT)
         if t.year < 1985 or t.year > 2084:
             logging.warning(u'Year %d is outside the allowed EDF range %d-%d. Should use EDF+' % (t.year, 1985, 2084))
+        data = self.filtered_array(filters, xoffset=xoffset, cols=cols)
+        cols = len(data)
+        samples_per_record = max(1, int(round(record_duration * self.sample_rate)))
+        record_duration = float(samples_per_record) / self.sample_rate
+        records = max(1, int(math.ceil(data.shape[1] / float(samples_per_record))))
+        if annotations is not None:
+            tals = edf_annotation_records(annotations, records, record_duration)
+            annotation_samples = max(len(tal) for tal in tals) // 2
+        signals = cols if annotations is None else cols + 1
         # Prepare data for the EDF header, use some of the additional specifications in EDF+.
-        edf_header_len = 8+80+80+8+8+8+44+8+8+4+(16+80+8+8+8+8+8+80+8+32)*cols
+        edf_header_len = 8+80+80+8+8+8+44+8+8+4+(16+80+8+8+8+8+8+80+8+32)*signals
         edf_hospital_code = ''
         if self.patient_sex == SEX_FEMALE:
             edf_sex = 'F'
@@ -237,40 +595,65 @@ class ecg():
         edf_patient_name = self.patient_name.replace(' ', '_')
         edf_local_patient_id = '%s %s %s %s' % (edf_hospital_code, edf_sex, edf_birthdate, edf_patient_name)
         edf_local_recording_id = 'Startdate %s %s' % (t.strftime('%d-%b-%Y').upper(), self.case)
-        with open(filename_edf, 'wb') as f:
-            # HEADER RECORD
-            f.write(bytes('%-8d' % (0,), 'ascii')[0:8])  # EDF Version
-            f.write(bytes('%-80s' % (edf_local_patient_id,), 'ascii', 'replace')[0:80])
-            f.write(bytes('%-80s' % (edf_local_recording_id,), 'ascii', 'replace')[0:80])
-            f.write(bytes(t.strftime('%d.%m.%y'), 'ascii'))
-            f.write(bytes(t.strftime('%H.%M.%S'), 'ascii'))
-            f.write(bytes('%-8d' % (edf_header_len,), 'ascii'))
-            f.write(bytes(' '*44, 'ascii'))
-            # NOTICE: Duration of data record can be a multiple of sample rate.
-            f.write(bytes('%-8d' % (self.samples,), 'ascii'))                # Data records
-            f.write(bytes('%-8.6f' % (1.0 / ECG90A_SAMPLE_RATE,), 'ascii'))  # Duration of one data record
-            f.write(bytes('%-4d' % (cols,), 'ascii'))                        # Nr of signals
-            for lead in range(0, cols): f.write(bytes('%-16s' % (ECG90A_LEADS[lead],), 'ascii')[0:16])  # Lead label
-            for lead in range(0, cols): f.write(bytes(' '*80, 'ascii'))                # Transducer type
-            for lead in range(0, cols): f.write(bytes('%-8s' % ('mV',), 'ascii'))      # Physical dimension
-            for lead in range(0, cols): f.write(bytes('%-8.2f' % (-1000.0,), 'ascii')) # Physical minimum
-            for lead in range(0, cols): f.write(bytes('%-8.2f' % (1000.0,), 'ascii'))  # Physical maximum
-            for lead in range(0, cols): f.write(bytes('%-8d' % (-32768,), 'ascii'))    # Digital minimum
-            for lead in range(0, cols): f.write(bytes('%-8d' % (32767,), 'ascii'))     # Digital maximum
-            for lead in range(0, cols): f.write(bytes(' '*80, 'ascii'))                # Prefiltering
-            for lead in range(0, cols): f.write(bytes('%-8d' % (1,), 'ascii'))         # Nr of samples in each data record
-            for lead in range(0, cols): f.write(bytes(' '*32, 'ascii'))                # Reserved
+        edf_reserved = '' if annotations is None else 'EDF+C'
+        if annotations is not None:
+            # EDF+ requires all the subfields, unknown ones are "X".
+            edf_local_patient_id = '%s %s %s %s' % (edf_hospital_code or 'X', edf_sex or 'X', 'X', edf_patient_name or 'X')
+            edf_local_recording_id = 'Startdate %s %s X ECG90A' % (t.strftime('%d-%b-%Y').upper(), self.case.replace(' ', '_') or 'X')
+        labels = [ECG90A_LEADS[lead] for lead in range(0, cols)]
+        # Per signal header fields, the annotations signal is the last one.
+        fields = [(label, 'mV', '%-8.2f' % (-1000.0,), '%-8.2f' % (1000.0,), samples_per_record) for label in labels]
+        if annotations is not None:
+            fields.append(('EDF Annotations', '', '-1', '1', annotation_samples))
+        # HEADER RECORD
+        header  = bytes('%-8d' % (0,), 'ascii')[0:8]  # EDF Version
+        header += bytes('%-80s' % (edf_local_patient_id,), 'ascii', 'replace')[0:80]
+        header += bytes('%-80s' % (edf_local_recording_id,), 'ascii', 'replace')[0:80]
+        header += bytes(t.strftime('%d.%m.%y'), 'ascii')
+        header += bytes(t.strftime('%H.%M.%S'), 'ascii')
+        header += bytes('%-8d' % (edf_header_len,), 'ascii')
+        header += bytes('%-44s' % (edf_reserved,), 'ascii')
+        header += bytes('%-8d' % (records,), 'ascii')                          # Data records
+        header += bytes(('%-8.6f' % (record_duration,))[0:8], 'ascii')        # Duration of one data record
+        header += bytes('%-4d' % (signals,), 'ascii')                          # Nr of signals
+        for field in fields: header += bytes('%-16s' % (field[0],), 'ascii')[0:16]  # Lead label
+        for field in fields: header += bytes(' '*80, 'ascii')                  # Transducer type
+        for field in fields: header += bytes('%-8s' % (field[1],), 'ascii')    # Physical dimension
+        for field in fields: header += bytes('%-8s' % (field[2],), 'ascii')    # Physical minimum
+        for field in fields: header += bytes('%-8s' % (field[3],), 'ascii')    # Physical maximum
+        for field in fields: header += bytes('%-8d' % (-32768,), 'ascii')      # Digital minimum
+        for field in fields: header += bytes('%-8d' % (32767,), 'ascii')       # Digital maximum
+        for field in fields: header += bytes(' '*80, 'ascii')                  # Prefiltering
+        for field in fields: header += bytes('%-8d' % (field[4],), 'ascii')    # Nr of samples in each data record
+        for field in fields: header += bytes(' '*32, 'ascii')                  # Reserved
+        with metrics.stage(metrics.STAGE_WRITE):
+            f.write(header)
             # DATA RECORD
-            for row in self.readline(xoffset=xoffset, cols=cols):
-                for val in row:
-                    # TODO: How to represent Null values in EDF?
-                    if val is None:
-                        val = 0
-                    f.write(struct.pack('<h', val))
+            # TODO: How to represent Null values in EDF?
+            # Samples are arranged as (records x signals x samples_per_record)
+            # and written as contiguous int16 blocks of EDF_RECORDS_PER_WRITE records.
+            values = np.zeros((cols, records * samples_per_record), dtype='<i2')
+            values[:, 0:data.shape[1]] = np.nan_to_num(data, nan=0)
+            values = values.reshape((cols, records, samples_per_record)).transpose((1, 0, 2))
+            for r in range(0, records, EDF_RECORDS_PER_WRITE):
+                block = values[r:r + EDF_RECORDS_PER_WRITE]
+                if annotations is None:
+                    f.write(np.ascontiguousarray(block).tobytes())
+                else:
+                    for k in range(0, len(block)):
+                        f.write(block[k].tobytes())
+                        f.write(tals[r + k].ljust(annotation_samples * 2, b'\x00'))
 
 
-    def export_scp(self, filename=None, overwrite=False, xoffset=ECG90A_XOFFSET):
+    def export_scp(self, filename=None, overwrite=False, xoffset=ECG90A_XOFFSET, compress=False, filters=None, measurements=None):
         """ Export data into a SCP-ECF file """
+        # If compress is True, data is stored as second differences
+        # encoded with the default Huffman table, so that longer
+        # recordings fit into the Section #6 16 bit byte counters.
+        # Optional filters are an ecg_filter.filter_chain, applied to
+        # all the leads before exporting (also in CSV and EDF).
+        # Optional measurements are an ecg_analysis result, stored
+        # into Section #7 (global measurements).
 
         if self.err != 0:
             logging.warning(u'ECG file header did not parsed correctly')
@@ -283,11 +666,7 @@ class ecg():
             logging.warning(u'Output file "%s" already exists, will not overwrite.' % (filename_scp,))
             self.err |= 0b00010000
             return None
-
-        # Section pointers are required at least from #0 to #11.
         s = {}
-        for sect_id in range(0, 12):
-            s[sect_id] = b''
 
         # Prepare Section #1 - Patient Data
         # Patient sex.
@@ -314,80 +693,292 @@ class ecg():
         s[1] += scp.make_tag(scp.TAG_ACQ_DEV_ID, scp.make_machine_id('ECG90A'))
         s[1] += scp.make_tag(scp.TAG_EOF, b'')
 
-        # Prepare Section #3 - ECG Lead Definition
-        leads_number = len(ECG90A_LEADS)
-        flag_byte = 0b00000000
-        flag_byte |= scp.ALL_SIMULTANEOUS_READ
-        flag_byte |= (leads_number << 3)  # Simultaneous lead.
-        s[3] = struct.pack('<B', leads_number)
-        s[3] += struct.pack('<B', flag_byte)
-        for i in range(0, leads_number):
-            starting_sample = 1
-            ending_sample = self.samples
-            lead_id = ECG90A_LEADS_SCP[i]
-            s[3] += struct.pack('<I', starting_sample)
-            s[3] += struct.pack('<I', ending_sample)
-            s[3] += struct.pack('<B', lead_id)
+        # Prepare Section #2 - Huffman Tables
+        if compress:
+            s[2] = struct.pack('<H', scp.DEFAULT_HUFFMAN_TABLE)
 
         # Prepare Section #6 - Rhythm data
+        # TODO: How to represent Null values in SCP-ECG?
+        data = np.nan_to_num(self.filtered_array(filters, xoffset=xoffset), nan=0).astype(np.int16)
         amplitude_multiplier = ECG90A_AMPL_NANOVOLT
         sample_time_interval = int(1000000 / self.sample_rate)  # In microseconds
-        s[6] = struct.pack('<H', amplitude_multiplier)
-        s[6] += struct.pack('<H', sample_time_interval)
-        s[6] += struct.pack('<B', scp.ENCODING_REAL)
-        s[6] += struct.pack('<B', scp.BIMODAL_COMPRESSION_FALSE)
-        # Bytes to store for each serie, limited to 16bit size counter (sic!)
-        bytes_to_store = int(self.samples * ECG90A_SAMPLE_BITS / 8)
-        max_samples = int(0xffff / (ECG90A_SAMPLE_BITS / 8))
-        if self.samples > max_samples:
-            logging.warning(u'Cannot store %d samples in SCP-ECG rhythm data, max is %d' % (self.samples, max_samples))
+        encoding = scp.ENCODING_SECOND_DIFF if compress else scp.ENCODING_REAL
+        s[6], stored_samples = scp.make_rhythm_section(data, amplitude_multiplier, sample_time_interval, encoding=encoding, huffman=compress)
+        if stored_samples < data.shape[1]:
             self.err |= 0b10000000
-            bytes_to_store = int(max_samples * (ECG90A_SAMPLE_BITS / 8))
-        for i in range(0, leads_number):
-            s[6] += struct.pack('<H', bytes_to_store)
-        all_rows = []
-        for row in self.readline(xoffset=xoffset):
-            all_rows.append(row)
-        for i in range(0, leads_number):
-            count = 0
-            serie = b''
-            for row in all_rows:
-                val = row[i]
-                # TODO: How to represent Null values in SCP-ECG?
-                if val is None:
-                    val = 0
-                serie += struct.pack('<h', val)
-                count += 1
-                if count >= max_samples:
-                    break
-            s[6] += serie
-
-        # Prepare Section #0 - Section Pointers
-        sect_id = 0
-        length = scp.SECTION_HEADER_LEN + scp.POINTER_FIELD_LEN * 12
-        index = scp.SCPECG_HEADER_LEN + 1
-        s[0] = scp.make_pointer_field(sect_id, length, index)
-        index += length
-        for sect_id in range(1, 12):
-            length = len(s[sect_id])
-            if length > 0:
-                length += scp.SECTION_HEADER_LEN
-            s[0] += scp.make_pointer_field(sect_id, length, index)
-            index += length 
+
+        # Prepare Section #3 - ECG Lead Definition
+        s[3] = scp.make_lead_definition([ECG90A_LEADS_SCP[i] for i in range(0, len(data))], stored_samples)
+
+        # Prepare Section #7 - Global Measurements
+        if measurements is not None:
+            import ecg_analysis
+            s[7] = ecg_analysis.scp_section(measurements, stored_samples)
 
         # Prepare SCP-ECG Record
-        # CRC(2bytes) + Size(4bytes) + Section #0 + Section #1 + ...
-        size = scp.SCPECG_HEADER_LEN
-        for sect_id in (0, 1, 2, 3, 6):
-            if len(s[sect_id]) > 0:
-                size += scp.SECTION_HEADER_LEN + len(s[sect_id])
-        scp_ecg = struct.pack('<I', size)
-        for sect_id in (0, 1, 2, 3, 6):
-            if len(s[sect_id]) > 0:
-                scp_ecg += scp.pack_section(sect_id, s[sect_id])
-        crc = struct.pack('<H', binascii.crc_hqx(scp_ecg, 0xffff))
-
-        f_out = open(filename_scp, 'wb')
-        f_out.write(crc + scp_ecg)
-        f_out.close()
+        with open(filename_scp, 'wb') as f_out:
+            scp.write_record(f_out, s)
         return filename_scp
+
+
+class follower(ecg):
+    """ Read an ECG90A file while it is still being written """
+
+    # Rows are returned only when at least FOOTER_LEN bytes follow
+    # them, so the footer is never taken as data. The file is complete
+    # when an all-zeros row is found, or when its size did not change
+    # for idle seconds; then the footer is read and the ecg methods
+    # (exporters, to_array(), etc.) can be used as with a normal file.
+
+    def __init__(self, filename, sample_rate=ECG90A_SAMPLE_RATE, data_series=ECG90A_DATA_SERIES, sample_bits=ECG90A_SAMPLE_BITS, poll=DEFAULT_FOLLOW_POLL, idle=DEFAULT_FOLLOW_IDLE):
+        self.err = 0
+        if (sample_bits % 8) != 0:
+            logging.error(u'sample_bits is not multiple of 8')
+            self.err |= 0b00000011
+            return None
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.data_series = data_series
+        self.sample_bits = sample_bits
+        self.mmap = False
+        self.cache = None
+        self.poll = poll
+        self.idle = idle
+        self.file_size = 0
+        self.file_timestamp = None
+        self.samples = 0
+        self.duration = 0.0
+        self.complete = False
+        self.footer = None
+        self.case = None
+        # File position of the next row to read.
+        self.offset = HEADER_LEN
+        self.last_growth = time.monotonic()
+        self.f = None
+
+
+    def check_size(self):
+        """ Update the file size, return True if the file did not grow for idle seconds """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            st = None
+        if st is not None and st.st_size != self.file_size:
+            self.file_size = st.st_size
+            self.file_timestamp = datetime.datetime.fromtimestamp(st.st_mtime)
+            self.last_growth = time.monotonic()
+        return (time.monotonic() - self.last_growth) >= self.idle
+
+
+    def read_available(self, rows=DEFAULT_CHUNK_ROWS):
+        """ Return the raw payload rows written so far (at most rows), without waiting """
+        if self.complete:
+            return None
+        idle = self.check_size()
+        if self.case is None:
+            if self.file_size < HEADER_LEN:
+                if idle:
+                    logging.error(u'Input file %s has no header after %.1f seconds' % (self.filename, self.idle))
+                    self.err |= 0b00000001
+                    self.complete = True
+                return None
+            self.f = open(self.filename, 'rb')
+            self.read_header(self.f)
+        bytes_per_row = self.data_series * int(self.sample_bits / 8)
+        count = min(rows, max(0, (self.file_size - FOOTER_LEN - self.offset) // bytes_per_row))
+        self.f.seek(self.offset)
+        payload = np.frombuffer(self.f.read(count * bytes_per_row), dtype='<u%d' % (int(self.sample_bits / 8),))
+        payload = payload.reshape((-1, self.data_series))
+        terminators = np.flatnonzero(~payload.any(axis=1))
+        if len(terminators) > 0:
+            # An all-zeros row means end of data.
+            payload = payload[0:int(terminators[0])]
+            self.finish()
+        elif count < rows and idle:
+            payload_len = self.file_size - HEADER_LEN - FOOTER_LEN
+            if (payload_len % bytes_per_row) != 0:
+                logging.error(u'File size mismatch: (%d - %d - %d) = %d is not multiple of %d' % (self.file_size, HEADER_LEN, FOOTER_LEN, payload_len, bytes_per_row))
+                self.err |= 0b00000010
+            self.finish()
+        self.offset += len(payload) * bytes_per_row
+        self.samples += len(payload)
+        self.duration = float(self.samples / self.sample_rate)
+        return payload
+
+
+    def finish(self):
+        """ Read the footer and close the file """
+        self.f.seek(max(HEADER_LEN, self.file_size - FOOTER_LEN))
+        self.footer = self.f.read(FOOTER_LEN)
+        self.payload_len = self.samples * self.data_series * int(self.sample_bits / 8)
+        self.f.close()
+        self.f = None
+        self.complete = True
+
+
+    def chunks(self, rows=DEFAULT_CHUNK_ROWS, leads=None, xoffset=ECG90A_XOFFSET):
+        """ Yield data as (leads x rows) arrays as soon as it is written, until the file is complete """
+        # Chunks may be shorter than rows, waiting is done in steps
+        # of poll seconds.
+        while not self.complete:
+            payload = self.read_available(rows)
+            if payload is not None and len(payload) > 0:
+                if leads is None:
+                    leads = range(0, self.leads_count())
+                yield self.lead_values(payload, leads, xoffset=xoffset)
+            elif not self.complete:
+                time.sleep(self.poll)
+
+
+class recording():
+    """ Data series as int16 with a packed bitmask of NULL values; I, aVR, aVL and aVF are derived on demand """
+
+    def __init__(self, series, null_bits, sample_rate=ECG90A_SAMPLE_RATE):
+        # series: (data_series x samples) int16, missing values stored as zero.
+        # null_bits: the missing values mask, packed along the samples axis.
+        self.series = series
+        self.null_bits = null_bits
+        self.sample_rate = sample_rate
+        self.data_series, self.samples = series.shape
+        self.duration = float(self.samples / self.sample_rate)
+        self._derived = {}
+
+
+    @property
+    def nbytes(self):
+        """ Memory used by the data series and the NULL mask, in bytes """
+        return self.series.nbytes + self.null_bits.nbytes
+
+
+    def leads_count(self):
+        """ Return the number of leads available from the data series """
+        return self.data_series if self.data_series < 2 else self.data_series + 4
+
+
+    def null_mask(self, k):
+        """ Return the boolean mask of missing values in data serie k """
+        return np.unpackbits(self.null_bits[k], count=self.samples).astype(bool)
+
+
+    def lead(self, lead):
+        """ Return (values, missing) of a lead: int16 values and a boolean mask """
+        # Einthoven formulas use integer division truncated toward
+        # zero, as ecg.lead_values() does. Derived leads are cached.
+        if self.data_series < 2:
+            return (self.series[lead], self.null_mask(lead))
+        if lead >= 6:
+            return (self.series[lead - 4], self.null_mask(lead - 4))
+        if lead == 1 or lead == 2:
+            return (self.series[lead - 1], self.null_mask(lead - 1))
+        if lead not in self._derived:
+            ii = self.series[0].astype(np.int32)
+            iii = self.series[1].astype(np.int32)
+            half = lambda x: np.sign(x) * (np.abs(x) // 2)
+            if lead == 0:
+                values = ii - iii
+            elif lead == 3:
+                values = half(iii) - ii
+            elif lead == 4:
+                values = half(ii) - iii
+            elif lead == 5:
+                values = half(ii + iii)
+            missing = self.null_mask(0) | self.null_mask(1)
+            values[missing] = 0
+            self._derived[lead] = (values.astype(np.int16), missing)
+        return self._derived[lead]
+
+
+    def to_array(self, leads=None, t0=0.0, t1=None):
+        """ Return leads from t0 to t1 (seconds) as float64, missing values are numpy.nan """
+        if leads is None:
+            leads = range(0, self.leads_count())
+        row0 = min(max(0, int(round(t0 * self.sample_rate))), self.samples)
+        row1 = self.samples if t1 is None else min(max(row0, int(round(t1 * self.sample_rate))), self.samples)
+        data = np.empty((len(leads), row1 - row0), dtype=np.float64)
+        for j, lead in enumerate(leads):
+            values, missing = self.lead(lead)
+            data[j] = values[row0:row1]
+            data[j][missing[row0:row1]] = np.nan
+        return data
+
+
+    def as_millivolt(self, leads=None, t0=0.0, t1=None):
+        """ Return leads from t0 to t1 (seconds) converted into millivolt """
+        return self.to_array(leads, t0, t1) * (ECG90A_AMPL_NANOVOLT / 1000000.0)
+
+
+class columnar():
+    """ Read files written by ecg.export_columnar(), loading only the requested leads """
+
+    def __init__(self, filename, mmap=True):
+        # Leads stored uncompressed are memory-mapped if mmap is
+        # True; compressed ones are decompressed on first access.
+        self.filename = filename
+        self.mmap = mmap
+        self.npz = np.load(filename, allow_pickle=False)
+        self.meta = json.loads(str(self.npz['meta']))
+        if self.meta.get('format') != COLUMNAR_FORMAT:
+            raise ValueError(u'File "%s" is not a columnar ECG file' % (filename,))
+        self.leads = self.meta['leads']
+        self.sample_rate = self.meta['sample_rate']
+        self.samples = self.meta['samples']
+        self._members = None
+
+
+    def close(self):
+        self.npz.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def memmap(self, name):
+        """ Return the named array memory-mapped from the file, None if it is compressed """
+        if self._members is None:
+            with zipfile.ZipFile(self.filename) as z:
+                self._members = dict((info.filename, info) for info in z.infolist())
+        info = self._members.get(name + '.npy')
+        if info is None or info.compress_type != zipfile.ZIP_STORED:
+            return None
+        with open(self.filename, 'rb') as f:
+            # Skip the local file header, then parse the .npy header.
+            f.seek(info.header_offset)
+            local = f.read(30)
+            f.seek(info.header_offset + 30 + struct.unpack('<H', local[26:28])[0] + struct.unpack('<H', local[28:30])[0])
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        return np.memmap(self.filename, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+    def raw(self, lead):
+        """ Return (int16 values, missing mask or None) of a lead, by index or name """
+        name = self.leads[lead] if isinstance(lead, int) else lead
+        values = self.memmap(name) if self.mmap else None
+        if values is None:
+            values = self.npz[name]
+        null_name = 'null_' + name
+        missing = self.npz[null_name] if (null_name + '.npy') in self.npz.zip.namelist() else None
+        return (values, missing)
+
+
+    def lead(self, lead):
+        """ Return a lead as float64, missing values are numpy.nan """
+        values, missing = self.raw(lead)
+        data = values.astype(np.float64)
+        if missing is not None:
+            data[missing] = np.nan
+        return data
+
+
+    def as_millivolt(self, lead):
+        """ Return a lead converted into millivolt """
+        return self.lead(lead) * (self.meta['amplitude_nanovolt'] / 1000000.0)
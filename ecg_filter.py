@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Filters for ECG lead data, applied to (leads x samples) arrays.
+
+Each filter is designed once as second-order sections (SOS) and
+cached by (type, cutoff, order, sample rate), so processing many
+files with the same settings does not design them again. A
+filter_chain applies all the filters to every lead in one call,
+or to consecutive chunks of data by means of a filter_stream.
+
+SciPy is imported only when a filter is designed or applied, so
+importing this module does not slow down programs which use no
+filters.
+
+Required Python packages: python3-numpy python3-scipy
+"""
+
+import ecg_metrics as metrics
+import numpy as np
+
+__author__ = "Niccolo Rigacci"
+__copyright__ = "Copyright 2020 Niccolo Rigacci <niccolo@rigacci.org>"
+__license__ = "GPLv3-or-later"
+__email__ = "niccolo@rigacci.org"
+__version__ = "0.1.0"
+
+LOWPASS = 'lowpass'
+HIGHPASS = 'highpass'
+NOTCH = 'notch'
+# Samples filtered at once by zero-phase filters, when streaming.
+DEFAULT_BLOCK = 8192
+
+# Filters already designed, keyed by (type, cutoff, order, fs).
+_sos_cache = {}
+
+
+def design(ftype, cutoff, order, fs):
+    """ Return the second-order sections of the filter, designed only once """
+    key = (ftype, float(cutoff), int(order), float(fs))
+    if key not in _sos_cache:
+        from scipy.signal import butter, iirnotch, tf2sos
+        nyq = 0.5 * fs
+        if ftype == LOWPASS:
+            sos = butter(order, cutoff / nyq, btype='low', analog=False, output='sos')
+        elif ftype == HIGHPASS:
+            sos = butter(order, cutoff / nyq, btype='high', analog=False, output='sos')
+        elif ftype == NOTCH:
+            # The quality (-3 dB threshold) is set at cutoff +/- 3 Hz.
+            b, a = iirnotch(cutoff / nyq, cutoff / 6.0)
+            sos = tf2sos(b, a)
+        else:
+            raise ValueError(u'Unknown filter type "%s"' % (ftype,))
+        _sos_cache[key] = sos
+    return _sos_cache[key]
+
+
+class filter_chain():
+    """ A sequence of filters applied to all the leads along the time axis """
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.stages = []
+
+
+    def lowpass(self, cutoff, order=2, zero_phase=True):
+        """ Add a Butterworth lowpass filter; zero_phase uses a forward-backward pass """
+        # The zero-phase filter is applied twice, so it performs
+        # about as a filter of double order applied only forward.
+        sos = design(LOWPASS, cutoff, order, self.fs)
+        if zero_phase:
+            self.stages.append(('sosfiltfilt', sos, u'Lowpass filtfilt(%.1f)' % (cutoff,)))
+        else:
+            self.stages.append(('sosfilt', sos, u'Lowpass lfilt(%.1f)' % (cutoff,)))
+        return self
+
+
+    def highpass(self, cutoff, order=2, zero_phase=True):
+        """ Add a Butterworth highpass filter, e.g. against baseline wander """
+        sos = design(HIGHPASS, cutoff, order, self.fs)
+        if zero_phase:
+            self.stages.append(('sosfiltfilt', sos, u'Highpass filtfilt(%.1f)' % (cutoff,)))
+        else:
+            self.stages.append(('sosfilt', sos, u'Highpass lfilt(%.1f)' % (cutoff,)))
+        return self
+
+
+    def notch(self, cutoff):
+        """ Add a band-stop filter at the specified cutoff frequency """
+        sos = design(NOTCH, cutoff, 2, self.fs)
+        self.stages.append(('sosfilt', sos, u'Notch iirnotch(%.1f)' % (cutoff,)))
+        return self
+
+
+    def smooth(self, size):
+        """ Add a moving average over size samples """
+        self.stages.append(('uniform', size, u'uniform_filter(size=%d)' % (size,)))
+        return self
+
+
+    def describe(self):
+        """ Return the list of labels of the applied filters """
+        return [label for stage, param, label in self.stages]
+
+
+    def apply(self, data):
+        """ Return a float64 copy of (leads x samples) data, with all the filters applied """
+        # Missing values (NaN) are filtered as zeros and are
+        # restored afterward, so they do not spread to the
+        # following samples.
+        y = np.array(data, dtype=np.float64, ndmin=2)
+        if len(self.stages) == 0 or y.shape[1] == 0:
+            return y
+        with metrics.stage(metrics.STAGE_FILTER):
+            from scipy.signal import sosfilt, sosfiltfilt
+            from scipy.ndimage import uniform_filter1d
+            missing = np.isnan(y)
+            y[missing] = 0.0
+            for stage, param, label in self.stages:
+                if stage == 'sosfilt':
+                    y = sosfilt(param, y, axis=1)
+                elif stage == 'sosfiltfilt':
+                    # Same padding as sosfiltfilt() default, limited for short signals.
+                    padlen = 3 * (2 * len(param) + 1 - min((param[:, 2] == 0).sum(), (param[:, 5] == 0).sum()))
+                    padlen = min(padlen, y.shape[1] - 1)
+                    y = sosfiltfilt(param, y, axis=1, padlen=padlen)
+                elif stage == 'uniform':
+                    y = uniform_filter1d(y, param, axis=1)
+            y[missing] = np.nan
+        return y
+
+
+    def stream(self, block=DEFAULT_BLOCK, overlap=None):
+        """ Return a filter_stream which applies the chain to consecutive chunks """
+        return filter_stream(self, block=block, overlap=overlap)
+
+
+class causal_stage():
+    """ Forward-only SOS filter, the state (zi) is carried between chunks """
+
+    def __init__(self, sos):
+        self.sos = sos
+        self.zi = None
+
+    def feed(self, x):
+        from scipy.signal import sosfilt
+        if self.zi is None:
+            self.zi = np.zeros((len(self.sos), x.shape[0], 2))
+        y, self.zi = sosfilt(self.sos, x, axis=1, zi=self.zi)
+        return y
+
+    def flush(self):
+        return None
+
+
+class uniform_stage():
+    """ Moving average, delayed until the samples on the right are available """
+
+    def __init__(self, size):
+        self.size = size
+        self.left = size // 2
+        self.right = size - 1 - self.left
+        # Input samples still needed as context, and how many of them are not yet output.
+        self.buf = None
+        self.pending = 0
+        self.started = False
+
+    def feed(self, x):
+        self.buf = x if self.buf is None else np.concatenate((self.buf, x), axis=1)
+        self.pending += x.shape[1]
+        if not self.started:
+            if self.pending < max(1, self.left):
+                return None
+            # Reflect the first samples, as uniform_filter1d() does.
+            if self.left > 0:
+                self.buf = np.concatenate((self.buf[:, self.left-1::-1], self.buf), axis=1)
+            self.started = True
+        return self.output()
+
+    def output(self):
+        ready = self.pending - self.right
+        if ready <= 0:
+            return None
+        start = self.buf.shape[1] - self.pending - self.left
+        window = self.buf[:, start:start + ready + self.left + self.right]
+        from scipy.ndimage import uniform_filter1d
+        y = uniform_filter1d(window, self.size, axis=1)[:, self.left:self.left + ready]
+        self.pending -= ready
+        self.buf = self.buf[:, self.buf.shape[1] - self.pending - self.left:]
+        return y
+
+    def flush(self):
+        if self.buf is None or self.pending == 0:
+            return None
+        if not self.started:
+            from scipy.ndimage import uniform_filter1d
+            return uniform_filter1d(self.buf, self.size, axis=1)
+        # Reflect the last samples, as uniform_filter1d() does.
+        self.buf = np.concatenate((self.buf, self.buf[:, :-self.right-1:-1]), axis=1) if self.right > 0 else self.buf
+        self.pending += self.right
+        y = self.output()
+        self.pending = 0
+        return y
+
+
+class zero_phase_stage():
+    """ Forward-backward SOS filter, applied to overlapped blocks """
+
+    def __init__(self, sos, block, overlap):
+        self.sos = sos
+        self.block = block
+        self.overlap = overlap
+        self.history = None
+        self.buf = None
+
+    def feed(self, x):
+        self.buf = x if self.buf is None else np.concatenate((self.buf, x), axis=1)
+        out = []
+        while self.buf.shape[1] >= self.block + self.overlap:
+            out.append(self.filter_block(self.buf[:, 0:self.block + self.overlap], self.block))
+            self.buf = self.buf[:, self.block:]
+        return np.concatenate(out, axis=1) if len(out) > 0 else None
+
+    def filter_block(self, x, n):
+        """ Filter x with the history on the left, return the first n samples """
+        left = 0 if self.history is None else self.history.shape[1]
+        window = x if self.history is None else np.concatenate((self.history, x), axis=1)
+        padlen = 3 * (2 * len(self.sos) + 1 - min((self.sos[:, 2] == 0).sum(), (self.sos[:, 5] == 0).sum()))
+        from scipy.signal import sosfiltfilt
+        y = sosfiltfilt(self.sos, window, axis=1, padlen=min(padlen, window.shape[1] - 1))
+        self.history = window[:, max(0, left + n - self.overlap):left + n]
+        return y[:, left:left + n]
+
+    def flush(self):
+        if self.buf is None or self.buf.shape[1] == 0:
+            return None
+        y = self.filter_block(self.buf, self.buf.shape[1])
+        self.buf = None
+        return y
+
+
+class filter_stream():
+    """ Apply a filter_chain to consecutive chunks of (leads x samples) data """
+
+    # Output samples are delayed by the zero-phase filters and by
+    # the moving average, but their total count equals the input.
+    # Forward-only filters give exactly the same values of
+    # filter_chain.apply(); zero-phase filters are applied to blocks
+    # which are extended with overlap samples on each side, their
+    # result converges to the one-shot result as overlap grows.
+
+    def __init__(self, chain, block=DEFAULT_BLOCK, overlap=None):
+        if overlap is None:
+            overlap = int(chain.fs)
+        self.stages = []
+        for stage, param, label in chain.stages:
+            if stage == 'sosfilt':
+                self.stages.append(causal_stage(param))
+            elif stage == 'sosfiltfilt':
+                self.stages.append(zero_phase_stage(param, block, overlap))
+            elif stage == 'uniform':
+                self.stages.append(uniform_stage(param))
+        # Missing values of the input not yet output.
+        self.missing = []
+
+    def feed(self, chunk):
+        """ Filter a chunk, return the filtered samples available so far (may be None) """
+        with metrics.stage(metrics.STAGE_FILTER):
+            y = np.array(chunk, dtype=np.float64, ndmin=2)
+            missing = np.isnan(y)
+            y[missing] = 0.0
+            self.missing.append(missing)
+            for stage in self.stages:
+                if y is None:
+                    break
+                y = stage.feed(y)
+            return self.restore_missing(y)
+
+    def flush(self):
+        """ Return the remaining filtered samples, at the end of data """
+        with metrics.stage(metrics.STAGE_FILTER):
+            y = None
+            for stage in self.stages:
+                if y is not None:
+                    y = stage.feed(y)
+                tail = stage.flush()
+                if tail is not None:
+                    y = tail if y is None else np.concatenate((y, tail), axis=1)
+            return self.restore_missing(y)
+
+    def restore_missing(self, y):
+        if y is None or y.shape[1] == 0:
+            return None
+        missing = np.concatenate(self.missing, axis=1)
+        y[missing[:, 0:y.shape[1]]] = np.nan
+        self.missing = [missing[:, y.shape[1]:]]
+        return y
+
+    def filter(self, chunks):
+        """ Yield the filtered data, from an iterable of chunks """
+        for chunk in chunks:
+            y = self.feed(chunk)
+            if y is not None:
+                yield y
+        y = self.flush()
+        if y is not None:
+            yield y
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of the conversion stages.
+
+When a recorder is enabled, the ecg_* modules record the wall time
+of each stage (header parsing, payload decoding, filtering, plot
+points generation, rendering, writing) and some counters: bytes read
+and written, samples decoded, missing values and the error flags of
+the recordings. Results are available as a dictionary, and each
+completed stage can be passed to a callback, e.g. json_lines().
+
+Instrumentation is disabled by default: each probe then costs a
+function call and a comparison, and probes are placed per block of
+data, never per sample. Stages executed by worker processes (e.g.
+PNG pages rendered in parallel) are not recorded.
+
+    import ecg_metrics as metrics
+    rec = metrics.enable()
+    ...
+    print(rec.as_dict())
+    metrics.disable()
+"""
+
+import json
+import time
+
+__author__ = "Niccolo Rigacci"
+__copyright__ = "Copyright 2020 Niccolo Rigacci <niccolo@rigacci.org>"
+__license__ = "GPLv3-or-later"
+__email__ = "niccolo@rigacci.org"
+__version__ = "0.1.0"
+
+# Stage names used by the ecg_* modules.
+STAGE_HEADER = 'header'
+STAGE_READ = 'read'
+STAGE_DECODE = 'decode'
+STAGE_FILTER = 'filter'
+STAGE_POINTS = 'points'
+STAGE_RENDER = 'render'
+STAGE_WRITE = 'write'
+# Counter names used by the ecg_* modules.
+BYTES_READ = 'bytes_read'
+BYTES_WRITTEN = 'bytes_written'
+SAMPLES_DECODED = 'samples_decoded'
+NULL_VALUES = 'null_values'
+# Error flags, OR-ed together.
+ERR = 'err'
+
+# The enabled recorder, None if instrumentation is disabled.
+_recorder = None
+
+
+class recorder():
+    """ Wall time of the stages and counters, collected while enabled """
+
+    def __init__(self, callback=None):
+        # Stages are {name: [calls, seconds]}; callback (if not None)
+        # is called with an event dictionary when a stage completes.
+        self.stages = {}
+        self.counters = {}
+        self.flags = {}
+        self.callback = callback
+
+
+    def stage(self, name):
+        return timer(self, name)
+
+
+    def add_time(self, name, seconds):
+        if name not in self.stages:
+            self.stages[name] = [0, 0.0]
+        self.stages[name][0] += 1
+        self.stages[name][1] += seconds
+        if self.callback is not None:
+            self.callback({'event': 'stage', 'stage': name, 'seconds': seconds})
+
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+
+    def set_flags(self, name, value):
+        self.flags[name] = self.flags.get(name, 0) | int(value)
+
+
+    def as_dict(self):
+        """ Return the collected values as a JSON serializable dictionary """
+        return {
+            'stages': dict((name, {'calls': v[0], 'seconds': v[1]}) for name, v in self.stages.items()),
+            'counters': dict(self.counters),
+            'flags': dict(self.flags)}
+
+
+class timer():
+    """ Context manager adding its wall time to a recorder stage """
+
+    __slots__ = ('recorder', 'name', 't0')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.add_time(self.name, time.perf_counter() - self.t0)
+        return False
+
+
+class null_timer():
+    """ Context manager doing nothing, used while instrumentation is disabled """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = null_timer()
+
+
+def enable(callback=None):
+    """ Start recording into a new recorder, which is returned """
+    global _recorder
+    _recorder = recorder(callback)
+    return _recorder
+
+
+def disable():
+    """ Stop recording, return the recorder that was enabled (or None) """
+    global _recorder
+    rec, _recorder = _recorder, None
+    return rec
+
+
+def enabled():
+    return _recorder is not None
+
+
+def stage(name):
+    """ Return a context manager which records the wall time of a stage """
+    if _recorder is None:
+        return NULL_TIMER
+    return _recorder.stage(name)
+
+
+def count(name, value=1):
+    """ Add value to a counter """
+    if _recorder is not None:
+        _recorder.count(name, value)
+
+
+def set_flags(name, value):
+    """ OR value into a bitmask, e.g. the err flags of a recording """
+    if _recorder is not None:
+        _recorder.set_flags(name, value)
+
+
+def json_lines(f):
+    """ Return a callback writing each event as a JSON line into the text stream f """
+    def callback(event):
+        f.write(json.dumps(event, sort_keys=True) + '\n')
+    return callback
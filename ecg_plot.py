@@ -0,0 +1,759 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Plot electrocardiogram data into a Reportlab drawing, which can be
+saved in PDF (vector) or PNG (raster) format.
+
+The Reportlab renderers, the PIL and SciPy packages are imported
+only when they are needed, i.e. when saving in the corresponding
+format or when filtering data.
+
+Required custom modules: ecg_contec.py (which requires ecg_scp.py), ecg_filter.py, ecg_pyramid.py
+Required Python packages: python3-numpy python3-scipy python3-reportlab
+"""
+
+import ecg_contec as contec
+import ecg_filter
+import ecg_metrics as metrics
+import ecg_pyramid
+import copy
+import hashlib
+import logging
+import math
+import os.path
+import numpy as np
+from reportlab.graphics.shapes import Drawing, Line, PolyLine, String, Group, colors
+from reportlab.lib.units import mm, inch
+from reportlab.lib.colors import HexColor
+
+__author__ = "Niccolo Rigacci"
+__copyright__ = "Copyright 2020 Niccolo Rigacci <niccolo@rigacci.org>"
+__license__ = "GPLv3-or-later"
+__email__ = "niccolo@rigacci.org"
+__version__ = "0.1.0"
+
+# Fonts are searched into the "fonts" directory beside this module.
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
+# Units of measure for PDF (vector) and PNG (raster at 300 dpi) output.
+PDF_UNIT = mm
+PNG_UNIT = mm * 300 / inch
+# Graph paper pre-rendered for PNG output is cached into this directory.
+PAPER_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ecg2pdf')
+# Graph paper drawings already built by this process, keyed by layout.
+_graph_papers = {}
+# Fonts are registered once per process.
+_fonts_registered = False
+
+def register_fonts():
+    """ Register the TTF fonts used in the drawings, once per process """
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    pdfmetrics.registerFont(TTFont('sans-cond', os.path.join(FONTS_DIR, 'DejaVuSansCondensed.ttf')))
+    pdfmetrics.registerFont(TTFont('sans-mono', os.path.join(FONTS_DIR, 'DejaVuSansMono.ttf')))
+    pdfmetrics.registerFont(TTFont('sans-mono-bold', os.path.join(FONTS_DIR, 'DejaVuSansMono-Bold.ttf')))
+    _fonts_registered = True
+
+
+class ecg_plot():
+
+    # Default unit of measure is mm, suitable for PDF (vector) output.
+    DEFAULT_UNIT = mm
+    # Sizes should be scaled for 300 dpi raster output.
+    #DEFAULT_UNIT = mm * 300 / inch
+
+    # Graphical elements size (in mm).
+    DEFAULT_PAPER_W = 297.0
+    DEFAULT_PAPER_H = 210.0
+    MARGIN_LEFT = 8.0
+    MARGIN_RIGHT = 8.0
+    MARGIN_TOP = 10.0
+    MARGIN_BOTTOM = 15.0
+    FONT_SIZE = 4.00
+    FONT_SMALL_SIZE = 3.50
+    THICK_LINE = 0.24
+    THIN_LINE = 0.16
+
+    DEFAULT_ROWS = 6
+    DEFAULT_COLS = 2
+    DEFAULT_SPEED = 25.0  # Default X-axis scale is 25 mm/s
+    DEFAULT_LEADS_TO_PLOT = list(range(0, 12))
+    LEAD_LABEL = (u'I', u'II', u'III', u'aVR', u'aVL', u'aVF', u'V1', u'V2', u'V3', u'V4', u'V5', u'V6')
+
+    LINEJOIN_MITER = 0
+    LINEJOIN_ROUND = 1
+    LINEJOIN_BEVEL = 2
+
+    # The following values can be changed before calling add_lead_plots().
+    # X-distance between polot points (in self.unit).
+    PLOT_PITCH = 0.2
+    # Apply an uniform_filter() if each PLOT_PITCH covers more than MIN sample points.
+    UNIFORM_FILTER_MIN_PTS = 4
+    # Use scipy.signal.lfilter() instead of scipy.signal.filtfilt() for low-pass filtering.
+    USE_LFILTER = False
+    # Lead plotted by add_overview_plots() if not specified (II).
+    OVERVIEW_LEAD = 1
+    # Seconds of data to load before and after the plotting interval, to let filters settle.
+    DATA_PADDING = 2.0
+
+
+    class line_style():
+        def __init__(self, strokeColor=colors.black, strokeWidth=1, strokeLineCap=0, strokeLineJoin=0, strokeMiterLimit=0, strokeDashArray=None, strokeOpacity=None):
+            self.strokeColor = strokeColor
+            self.strokeWidth = strokeWidth
+            self.strokeLineJoin = strokeLineJoin
+
+
+    class string_style():
+        def __init__(self, fontName='Times-Roman', fontSize=10, fillColor=colors.black, textAnchor='start'):
+            self.fontName = fontName
+            self.fontSize = fontSize
+            self.fillColor = fillColor
+            self.textAnchor = textAnchor
+
+
+    def __init__(self, unit=DEFAULT_UNIT, paper_w=DEFAULT_PAPER_W, paper_h=DEFAULT_PAPER_H, cols=DEFAULT_COLS, rows=DEFAULT_ROWS, time0=0.0, ampli=None, speed=DEFAULT_SPEED, paper_cache_dir=PAPER_CACHE_DIR):
+        register_fonts()
+        self.unit = unit
+        self.paper_w = paper_w
+        self.paper_h = paper_h
+        self.cols = cols
+        self.rows = rows
+        self.time0 = time0
+        self.ampli = ampli
+        self.speed = speed
+        self.leads_to_plot = self.DEFAULT_LEADS_TO_PLOT
+        # Time (in seconds) of the first sample in lead data.
+        self.data_time0 = 0.0
+        self.lowpass = None
+        self.notch = None
+        # Draw the min/max envelope instead of the uniform_filter(), when
+        # each plot pitch covers many samples. The ecg_pyramid of lead
+        # data is built from the data to plot, if not provided.
+        self.envelope = False
+        self.pyramid = None
+        # Calculated sizes.
+        self.graph_w = int((self.paper_w - (self.MARGIN_LEFT + self.MARGIN_RIGHT)) / 10.0) * 10.0
+        self.graph_h = int((self.paper_h - (self.MARGIN_TOP + self.MARGIN_BOTTOM) - self.FONT_SIZE * 8) / 10.0) * 10.0
+        self.graph_x = (self.paper_w - self.graph_w) / 2.0
+        self.graph_y = self.MARGIN_BOTTOM
+        self.time1 = self.time0 + self.page_duration()
+        if self.ampli is None:
+            self.ampli = int((self.graph_h / (self.rows * 1.8)) / 5) * 5.0
+        # Calculated styles.
+        self.sty_line_thick  = self.line_style(strokeColor=HexColor('#e48485'), strokeWidth=self.THICK_LINE*self.unit)
+        self.sty_line_blue   = self.line_style(strokeColor=colors.blue, strokeWidth=self.THICK_LINE*self.unit)
+        self.sty_line_thin   = self.line_style(strokeColor=HexColor('#eecfce'), strokeWidth=self.THIN_LINE*self.unit)
+        self.sty_line_plot   = self.line_style(strokeColor=colors.black, strokeWidth=self.THICK_LINE*self.unit, strokeLineJoin=self.LINEJOIN_ROUND)
+        self.sty_str_bold    = self.string_style(fontName='sans-mono-bold', fontSize=self.FONT_SIZE*self.unit)
+        self.sty_str_regular = self.string_style(fontName='sans-cond', fontSize=self.FONT_SMALL_SIZE*self.unit)
+        self.sty_str_blue    = self.string_style(fontName='sans-mono', fontSize=self.FONT_SMALL_SIZE*self.unit, fillColor=colors.blue)
+        # Calculate how many sample points there are for each plot pitch.
+        self.samples_per_plot_pitch = 1 + int(contec.ECG90A_SAMPLE_RATE / self.speed * self.PLOT_PITCH)
+        # Label printed beside the printing interval, e.g. the page number.
+        self.page_label = None
+        # Measurements of ecg_analysis, printed with the patient data.
+        self.measurements = None
+        # Graph paper is added at save time, PNG backgrounds are cached here.
+        self.paper = False
+        self.paper_cache_dir = paper_cache_dir
+        # Preapre the drawing.
+        self.draw = Drawing(paper_w*self.unit, paper_h*self.unit)
+
+
+    def page_duration(self):
+        """ Time interval (in seconds) plotted on each sheet """
+        return (self.graph_w / self.cols) / self.speed
+
+
+    def axis_tick(self, x, y, s):
+        return self.draw_line(x, y-0.5, x, y+3, s)
+
+
+    def plot_separator(self, x, y, s):
+        return Group(self.draw_line(x, y+0.5, x, y+8.5, s), self.draw_line(x, y-0.5, x, y-8.5, s))
+
+
+    def draw_polyline(self, points, s):
+        return PolyLine(points, strokeColor=s.strokeColor, strokeWidth=s.strokeWidth, strokeLineJoin=s.strokeLineJoin)
+
+
+    def draw_line(self, x0, y0, x1, y1, s):
+        return Line(x0 * self.unit, y0 * self.unit, x1 * self.unit, y1 * self.unit, strokeColor=s.strokeColor, strokeWidth=s.strokeWidth)
+
+
+    def draw_text(self, x, y, text, s):
+        s1 = String(x * self.unit, y * self.unit, text)
+        s1.fontName = s.fontName
+        s1.fontSize = s.fontSize
+        s1.fillColor = s.fillColor
+        s1.textAnchor = s.textAnchor
+        return s1
+
+
+    def ticks_positions(self, x_min, x_max, mm_per_x_unit):
+        """ Calculate where to place the ticks over bottom X axis """
+        ticks = {}
+        axis_len = x_max - x_min
+        # Start searching a suitable span from the power of 10 above axis_len.
+        if axis_len < 1.0:
+            e = 10 ** int(math.log10(axis_len))
+        else:
+            e = 10 ** (int(math.log10(axis_len)) + 1)
+        m = 1
+        divs = 0
+        while divs < 5:
+            span = m * e
+            divs = int(axis_len / span)
+            if m == 1:
+                e = e / 10.0
+                m = 5
+            elif m == 5:
+                m = 2
+            else:
+                m = 1
+        if (x_min % span) == 0:
+            first_tick = (int(x_min / span)) * span
+        else:
+            first_tick = (int(x_min / span) + 1) * span
+        # Stop ticks 5mm before the axis end.
+        last_tick = x_max - (5.0 / mm_per_x_unit)
+        for x_val in np.arange(first_tick, last_tick, span):
+            position = (x_val - x_min) * mm_per_x_unit
+            ticks[position] = x_val
+        return ticks
+
+
+    def lead_plot_points(self, yp, x_offset, y_offset, width):
+        """ Return the polylines (lists of coordinates in self.unit) for one lead graph """
+        # Coordinates are shifted into the page by (x_offset, y_offset).
+        # The graph is split into separate polylines where data is missing.
+        if len(yp) == 0:
+            return []
+        with metrics.stage(metrics.STAGE_POINTS):
+            x = np.arange(0.0, width, self.PLOT_PITCH)
+            sample = (self.time0 - self.data_time0 + (x / self.speed)) * contec.ECG90A_SAMPLE_RATE
+            y = np.interp(sample, np.arange(0, len(yp)), yp, contec.NULL_VALUE, contec.NULL_VALUE)
+            valid = ~np.isnan(y) & (y != contec.NULL_VALUE)
+            y = y * contec.ECG90A_AMPL_NANOVOLT / 1000000.0 * self.ampli
+            points = np.column_stack(((x_offset + x) * self.unit, (y_offset + y) * self.unit))
+            # Find the (start, stop) indexes of each run of valid points.
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], valid.astype(np.int8), [0]))))
+            return [points[start:stop].ravel().tolist() for start, stop in zip(edges[0::2], edges[1::2])]
+
+
+    def lead_envelope_points(self, pyr, lead, x_offset, y_offset, width):
+        """ Return the polylines (lists of coordinates in self.unit) for one lead envelope """
+        # Each plot pitch gets the minimum and the maximum of the
+        # samples it covers, in alternate order, so peaks are not lost.
+        with metrics.stage(metrics.STAGE_POINTS):
+            x = np.arange(0.0, width, self.PLOT_PITCH)
+            times = self.time0 + np.append(x, x[-1] + self.PLOT_PITCH) / self.speed
+            mins, maxs = pyr.envelope(lead, times)
+            first = np.where(np.arange(len(x)) % 2 == 0, mins, maxs)
+            second = np.where(np.arange(len(x)) % 2 == 0, maxs, mins)
+            valid = ~np.isnan(first)
+            x = np.column_stack((x, x + self.PLOT_PITCH * 0.5)).ravel()
+            y = np.column_stack((first, second)).ravel() * contec.ECG90A_AMPL_NANOVOLT / 1000000.0 * self.ampli
+            points = np.column_stack(((x_offset + x) * self.unit, (y_offset + y) * self.unit)).reshape((-1, 4))
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], valid.astype(np.int8), [0]))))
+            return [points[start:stop].ravel().tolist() for start, stop in zip(edges[0::2], edges[1::2])]
+
+
+    def use_envelope(self):
+        """ True if leads are drawn as min/max envelopes """
+        return self.envelope and self.samples_per_plot_pitch >= self.UNIFORM_FILTER_MIN_PTS
+
+
+    def iirnotch_filter(self, data, cutoff, fs):
+        """ Apply a band-stop filter at the specified cutoff frequency """
+        return ecg_filter.filter_chain(fs).notch(cutoff).apply(data)[0]
+
+
+    def butter_lowpass_lfilter(self, data, cutoff, fs, order=5):
+        """ Apply the lfilter() lowpass filter at the specified cutoff frequency """
+        # The lfilter() function is not zero-phase, it usually
+        # adds different amounts of delay at different frequencies.
+        return ecg_filter.filter_chain(fs).lowpass(cutoff, order=order, zero_phase=False).apply(data)[0]
+
+
+    def butter_lowpass_filtfilt(self, data, cutoff, fs, order=2):
+        """ Apply the filtfilt() lowpass filter at the specified cutoff frequency """
+        # The filtfilt() function applies a linear filter twice,
+        # once forward and once backwards. It is zero-phase (doesn't
+        # shift the signal as it filters). The order of filtfilt()
+        # performs about twice the same order applied by lfilter().
+        return ecg_filter.filter_chain(fs).lowpass(cutoff, order=order).apply(data)[0]
+
+
+    def paper_key(self):
+        """ Return a string identifying the graph paper layout, resolution and colors """
+        dpi = int(round(self.unit * inch / mm))
+        key = u'%gx%g-%g-%g-%gx%g-%ddpi-%s-%s-%g-%g' % (
+            self.paper_w, self.paper_h, self.graph_x, self.graph_y, self.graph_w, self.graph_h, dpi,
+            self.sty_line_thin.strokeColor.hexval(), self.sty_line_thick.strokeColor.hexval(), self.THIN_LINE, self.THICK_LINE)
+        return key
+
+
+    def graph_paper(self):
+        """ Return the Group of graph paper lines, built once per process for each layout """
+        key = self.paper_key()
+        if key not in _graph_papers:
+            group = Group()
+            x0 = self.graph_x
+            x1 = self.graph_x + self.graph_w
+            y0 = self.graph_y
+            y1 = self.graph_y + self.graph_h
+            step = 1.0
+            for x in np.arange(x0, x1+0.1, step):
+                group.add(self.draw_line(x, y0, x, y1, self.sty_line_thin))
+            for y in np.arange(y0, y1+0.1, step):
+                group.add(self.draw_line(x0, y, x1, y, self.sty_line_thin))
+            step = 5.0
+            for x in np.arange(x0, x1+0.1, step):
+                group.add(self.draw_line(x, y0, x, y1, self.sty_line_thick))
+            for y in np.arange(y0, y1+0.1, step):
+                group.add(self.draw_line(x0, y, x1, y, self.sty_line_thick))
+            _graph_papers[key] = group
+        return _graph_papers[key]
+
+
+    def graph_paper_image(self):
+        """ Return the graph paper pre-rendered as a PIL image, cached on disk if possible """
+        from PIL import Image
+        from reportlab.graphics import renderPM
+        name = None
+        if self.paper_cache_dir is not None:
+            digest = hashlib.sha1(self.paper_key().encode('utf-8')).hexdigest()
+            name = os.path.join(self.paper_cache_dir, u'paper-%s.png' % (digest,))
+            if os.path.exists(name):
+                try:
+                    return Image.open(name).convert('RGB')
+                except OSError:
+                    pass
+        draw = Drawing(self.paper_w*self.unit, self.paper_h*self.unit)
+        draw.add(self.graph_paper())
+        image = renderPM.drawToPIL(draw)
+        if name is not None:
+            try:
+                os.makedirs(self.paper_cache_dir, exist_ok=True)
+                # Write to a temporary file first: other processes may read the cache.
+                tmp_name = u'%s.%d.tmp' % (name, os.getpid())
+                image.save(tmp_name, 'PNG')
+                os.replace(tmp_name, name)
+            except OSError as e:
+                logging.warning(u'Cannot write graph paper cache: %s' % (e,))
+        return image
+
+
+    def add_graph_paper(self):
+        """ Draw graph paper: thick/thin horizontal/vertical lines """
+        # The graph paper is not added to the drawing: save() puts it
+        # beneath, as a PDF form XObject or as a cached PNG background.
+        self.paper = True
+
+
+    def add_case_data(self, ecg):
+        """ Print file and case info """
+        col_left = (
+            'Filename: %s' % (ecg.filename,),
+            'Case: %s' % (ecg.case,),
+            'Date: %s' % (ecg.timestamp,),
+            'Duration: %.1f s' % (ecg.duration,)
+        )
+        x = self.graph_x
+        y = self.paper_h - self.MARGIN_TOP - self.FONT_SIZE * 1.125
+        for d in col_left:
+            self.draw.add(self.draw_text(x, y, d, self.sty_str_bold))
+            y -= self.FONT_SIZE * 1.125
+
+
+    def add_patient_data(self, ecg):
+        """ Print patient data """
+        print_name = ecg.patient_name if ecg.patient_name != u'' else u'.'*8
+        print_age = ecg.patient_age if ecg.patient_age > 0 else u'.'*3
+        print_weight = ecg.patient_weight if ecg.patient_weight > 0 else u'.'*3
+        print_sex = ecg.patient_sex_label if ecg.patient_sex <= 1 else u'.'*3
+        col_right = (
+            'Patient: %s' % (print_name,),
+            'Age: %s, Sex: %s, Weight: %s' % (print_age, print_sex, print_weight)
+        )
+        if self.measurements is not None:
+            import ecg_analysis
+            col_right += tuple(ecg_analysis.format_measurements(self.measurements))
+        x = self.graph_x + self.graph_w / 2.0
+        y = self.paper_h - self.MARGIN_TOP - self.FONT_SIZE * 1.125
+        for d in col_right:
+            self.draw.add(self.draw_text(x, y, d, self.sty_str_bold))
+            y -= self.FONT_SIZE * 1.125
+
+
+    def add_plot_info_text(self):
+        """ Text above and below the graph paper """
+        x = self.graph_x + 1.0
+        y = self.graph_y + self.graph_h + self.FONT_SMALL_SIZE * 0.33
+        text = u'Printing interval: %.1fs ÷ %.1fs' % (self.time0, self.time1)
+        if self.page_label is not None:
+            text += u' %s %s' % (u' '*6, self.page_label)
+        self.draw.add(self.draw_text(x, y, text, self.sty_str_regular))
+        y = self.MARGIN_BOTTOM - self.FONT_SMALL_SIZE * 1.125
+        text = u'Speed: %.2fmm/s %s Leads: %.2fmm/mV' % (self.speed, u' '*6, self.ampli)
+        self.draw.add(self.draw_text(x, y, text, self.sty_str_regular))
+
+
+    def add_plot_filter_text(self):
+        """ Filter description below the graph paper """
+        x = self.graph_x + (self.graph_w / 2) - 40
+        y = self.MARGIN_BOTTOM - self.FONT_SMALL_SIZE * 1.125
+        text = u'Sample Rate: %dHz; Filter: ' % (contec.ECG90A_SAMPLE_RATE,)
+        labels = []
+        if self.lowpass is not None:
+            filter_algo = u'lfilter' if self.USE_LFILTER else u'filtfilt'
+            labels.append(u'Lowpass (%s) %.1fHz' % (filter_algo, self.lowpass))
+        if self.notch is not None:
+            labels.append(u'Notch %.1fHz' % (self.notch,))
+        if self.use_envelope():
+            labels.append(u'Envelope min/max %dpt' % (self.samples_per_plot_pitch,))
+        elif self.samples_per_plot_pitch >= self.UNIFORM_FILTER_MIN_PTS:
+            labels.append(u'Uniform %dpt' % (self.samples_per_plot_pitch,))
+        if len(labels) > 0:
+            text += ', '.join(labels)
+        else:
+            text += u'None'
+        self.draw.add(self.draw_text(x, y, text, self.sty_str_regular))
+
+
+    def filters(self):
+        """ Return the filter_chain required by the lowpass, notch and pitch settings """
+        chain = ecg_filter.filter_chain(contec.ECG90A_SAMPLE_RATE)
+        if self.lowpass is not None:
+            if self.USE_LFILTER:
+                chain.lowpass(self.lowpass, order=5, zero_phase=False)
+            else:
+                chain.lowpass(self.lowpass, order=2)
+        if self.notch is not None:
+            chain.notch(self.notch)
+        # If many points per pitch, apply an uniform_filter on them.
+        if self.samples_per_plot_pitch >= self.UNIFORM_FILTER_MIN_PTS and not self.use_envelope():
+            chain.smooth(self.samples_per_plot_pitch)
+        return chain
+
+
+    def filter_data(self, data):
+        """ Return a copy of data, with the required filters applied to the leads to plot """
+        filt_data = np.array(data, dtype=np.float64)
+        chain = self.filters()
+        leads = [i for i in self.leads_to_plot if i < len(filt_data)]
+        filt_data[leads] = chain.apply(filt_data[leads])
+        for i in leads:
+            logging.debug(u'%3s: %s' % (self.LEAD_LABEL[i], '; '.join(chain.describe())))
+        return filt_data
+
+
+    def add_lead_plots(self, data, offset=0, filtered=False):
+        """ Lead plots, aligned into a grid of ROWS x COLS """
+        if not filtered:
+            data = self.filter_data(data)
+        pyr = self.lead_pyramid(data) if self.use_envelope() else None
+        ticks = self.ticks_positions(self.time0, self.time1, self.speed)
+        sector_w = self.graph_w / self.cols
+        sector_h = self.graph_h / self.rows
+        k = 0
+        for c in range(0, self.cols):
+            # Add the ticks over the X axis.
+            for pos in ticks:
+                x = pos + self.graph_x + sector_w * c
+                self.draw.add(self.axis_tick(x, self.MARGIN_BOTTOM, self.sty_line_blue))
+                self.draw.add(self.draw_text(x+0.2, self.MARGIN_BOTTOM+0.2, '%.1f' % ticks[pos], self.sty_str_blue))
+            for r in range(0, self.rows):
+                if k >= len(self.leads_to_plot):
+                    break
+                i = self.leads_to_plot[k]
+                label = self.LEAD_LABEL[i]
+                x0 = self.FONT_SIZE + self.graph_x + sector_w * c
+                y0 = (self.graph_y + self.graph_h) - self.FONT_SIZE - sector_h * r
+                self.draw.add(self.draw_text(x0, y0, label, self.sty_str_bold))
+                if c > 0:
+                    x = self.graph_x + sector_w * c
+                    y = self.graph_y + self.graph_h - sector_h * (r + 0.5)
+                    self.draw.add(self.plot_separator(x, y, self.sty_line_plot))
+                x_offset = self.graph_x + sector_w * c
+                y_offset = self.graph_y + self.graph_h - sector_h * (r + 0.5) - offset
+                if pyr is not None:
+                    polylines = self.lead_envelope_points(pyr, i, x_offset, y_offset, sector_w)
+                else:
+                    polylines = self.lead_plot_points(data[i], x_offset, y_offset, sector_w)
+                for p in polylines:
+                    if len(p) > 2:
+                        self.draw.add(self.draw_polyline(p, self.sty_line_plot))
+                k += 1
+
+
+    def lead_pyramid(self, data):
+        """ Return self.pyramid, or build it from (filtered) lead data """
+        if self.pyramid is None:
+            self.pyramid = ecg_pyramid.build(data, contec.ECG90A_SAMPLE_RATE, time0=self.data_time0)
+        return self.pyramid
+
+
+    def add_overview_plots(self, pyr, time1, lead=OVERVIEW_LEAD):
+        """ The whole recording at a glance: one lead envelope, split into ROWS strips """
+        # The speed is chosen to fit the interval from time0 to time1
+        # into the strips; the time needed does not depend on the
+        # recording length, only on the graph width.
+        strip = (time1 - self.time0) / self.rows
+        self.time1 = time1
+        self.speed = self.graph_w / strip
+        self.samples_per_plot_pitch = 1 + int(contec.ECG90A_SAMPLE_RATE / self.speed * self.PLOT_PITCH)
+        self.envelope = True
+        self.pyramid = pyr
+        time0 = self.time0
+        sector_h = self.graph_h / self.rows
+        for r in range(0, self.rows):
+            self.time0 = time0 + strip * r
+            x0 = self.FONT_SIZE + self.graph_x
+            y0 = (self.graph_y + self.graph_h) - self.FONT_SIZE - sector_h * r
+            label = u'%s %d:%02d:%02d' % (self.LEAD_LABEL[lead], self.time0 // 3600, self.time0 % 3600 // 60, self.time0 % 60)
+            self.draw.add(self.draw_text(x0, y0, label, self.sty_str_bold))
+            y_offset = self.graph_y + self.graph_h - sector_h * (r + 0.5)
+            for p in self.lead_envelope_points(pyr, lead, self.graph_x, y_offset, self.graph_w):
+                if len(p) > 2:
+                    self.draw.add(self.draw_polyline(p, self.sty_line_plot))
+        self.time0 = time0
+
+
+    def add_sheet(self, ecg, data):
+        """ Graph paper, case and patient data, lead plots and filter info """
+        self.add_graph_paper()
+        self.add_case_data(ecg)
+        self.add_patient_data(ecg)
+        self.add_plot_info_text()
+        self.add_lead_plots(data)
+        self.add_plot_filter_text()
+
+
+    def static_layer(self, ecg):
+        """ Return a Group with graph paper, case and patient data, shared by all the pages """
+        draw = self.draw
+        self.draw = Group()
+        self.add_graph_paper()
+        self.add_case_data(ecg)
+        self.add_patient_data(ecg)
+        layer, self.draw = self.draw, draw
+        return layer
+
+
+    def add_page(self, static_layer, data, time0, page_label=None):
+        """ Start a new drawing which plots filtered data from time0 """
+        self.time0 = time0
+        self.time1 = self.time0 + self.page_duration()
+        self.page_label = page_label
+        self.draw = Drawing(self.paper_w*self.unit, self.paper_h*self.unit)
+        self.draw.add(static_layer)
+        self.add_plot_info_text()
+        self.add_lead_plots(data, filtered=True)
+        self.add_plot_filter_text()
+        return self.draw
+
+
+    def draw_pdf_page(self, pdf):
+        """ Draw the current drawing into a new page of the PDF canvas """
+        from reportlab.graphics import renderPDF
+        with metrics.stage(metrics.STAGE_RENDER):
+            if self.paper:
+                # The graph paper form is defined once per canvas.
+                form = u'paper-%s' % (hashlib.sha1(self.paper_key().encode('utf-8')).hexdigest(),)
+                if not pdf.hasForm(form):
+                    pdf.beginForm(form)
+                    renderPDF.draw(self.paper_drawing(), pdf, 0, 0)
+                    pdf.endForm()
+                pdf.doForm(form)
+            renderPDF.draw(self.draw, pdf, 0, 0)
+            pdf.showPage()
+
+
+    def paper_drawing(self):
+        """ Return a Drawing containing only the graph paper """
+        draw = Drawing(self.paper_w*self.unit, self.paper_h*self.unit)
+        draw.add(self.graph_paper())
+        return draw
+
+
+    def save(self, filename, png=False, title=''):
+        """ Write the drawing into a PNG or PDF file """
+        if png:
+            from PIL import ImageChops
+            from reportlab.graphics import renderPM
+            with metrics.stage(metrics.STAGE_RENDER):
+                image = renderPM.drawToPIL(self.draw)
+                if self.paper:
+                    # Traces are drawn over a white background, so multiplying
+                    # gives the same pixels as drawing them over the paper.
+                    image = ImageChops.multiply(self.graph_paper_image(), image)
+            with metrics.stage(metrics.STAGE_WRITE):
+                image.save(filename, 'PNG')
+        else:
+            from reportlab.pdfgen import canvas
+            pdf = canvas.Canvas(filename, pagesize=(self.paper_w*self.unit, self.paper_h*self.unit))
+            pdf.setTitle(title)
+            self.draw_pdf_page(pdf)
+            with metrics.stage(metrics.STAGE_WRITE):
+                pdf.save()
+        metrics.count(metrics.BYTES_WRITTEN, os.path.getsize(filename))
+
+
+def page_times(time0, time1, duration):
+    """ Return the start time of each page plotting from time0 to time1 """
+    pages = max(1, int(math.ceil((time1 - time0) / duration - 1e-9)))
+    return [time0 + duration * k for k in range(0, pages)]
+
+
+def png_page_filename(filename, page):
+    """ Return the filename of a numbered PNG page """
+    if filename.lower().endswith('.png'):
+        filename = filename[:-4]
+    return u'%s-%03d.png' % (filename, page)
+
+
+def render_png_page(plot, static_layer, data, time0, page_label, filename):
+    """ Render one PNG page, can be executed into a worker process """
+    plot.add_page(static_layer, data, time0, page_label)
+    plot.save(filename, png=True)
+    return filename
+
+
+def page_slice(plot, data, time0):
+    """ Return a copy of plot and the filtered data rows required to plot a page from time0 """
+    # Worker processes receive only the page data (plus DATA_PADDING)
+    # and the pyramid bins of the page, not the whole recording.
+    fs = contec.ECG90A_SAMPLE_RATE
+    t0 = time0 - plot.DATA_PADDING
+    t1 = time0 + plot.page_duration() + plot.DATA_PADDING
+    row0 = min(data.shape[1], max(0, int(math.floor((t0 - plot.data_time0) * fs))))
+    row1 = max(row0, min(data.shape[1], int(math.ceil((t1 - plot.data_time0) * fs))))
+    page = copy.copy(plot)
+    page.data_time0 = plot.data_time0 + row0 / float(fs)
+    page.pyramid = None
+    if plot.use_envelope():
+        page.pyramid = plot.pyramid.crop(t0, t1, fs * plot.PLOT_PITCH / plot.speed)
+    return (page, data[:, row0:row1])
+
+
+def render_pages(plot, ecg, data, filename, time1=None, png=False, title='', jobs=1):
+    """ Plot data from plot.time0 to time1 on multiple pages, return the saved filenames """
+    # Data is filtered once and the static layer is drawn once for all
+    # the pages. PNG pages are rendered in parallel by jobs processes;
+    # PDF pages are drawn into a single multi-page file.
+    if time1 is None:
+        time1 = plot.data_time0 + data.shape[1] / float(contec.ECG90A_SAMPLE_RATE)
+    filt_data = plot.filter_data(data)
+    if plot.use_envelope():
+        # Build the pyramid once, before the pages are sliced for workers.
+        plot.lead_pyramid(filt_data)
+    layer = plot.static_layer(ecg)
+    times = page_times(plot.time0, time1, plot.page_duration())
+    labels = [u'Page %d/%d' % (k + 1, len(times)) for k in range(0, len(times))]
+    if png:
+        filenames = [png_page_filename(filename, k + 1) for k in range(0, len(times))]
+        if jobs > 1 and len(times) > 1:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=register_fonts) as executor:
+                futures = []
+                for t, label, name in zip(times, labels, filenames):
+                    page, page_data = page_slice(plot, filt_data, t)
+                    futures.append(executor.submit(render_png_page, page, layer, page_data, t, label, name))
+                return [f.result() for f in futures]
+        return [render_png_page(plot, layer, filt_data, t, label, name) for t, label, name in zip(times, labels, filenames)]
+    from reportlab.pdfgen import canvas
+    pdf = canvas.Canvas(filename, pagesize=(plot.paper_w*plot.unit, plot.paper_h*plot.unit))
+    pdf.setTitle(title)
+    for t, label in zip(times, labels):
+        plot.add_page(layer, filt_data, t, label)
+        plot.draw_pdf_page(pdf)
+    with metrics.stage(metrics.STAGE_WRITE):
+        pdf.save()
+    metrics.count(metrics.BYTES_WRITTEN, os.path.getsize(filename))
+    return [filename]
+
+
+class page_writer():
+    """ Plot pages from consecutive chunks of lead data, as soon as each page is complete """
+
+    # Chunks are filtered by an ecg_filter.filter_stream, PNG pages
+    # are saved as soon as their data is available, PDF pages are
+    # added to the canvas and the file is written by close(). The
+    # static layer is drawn again on each page, because the header
+    # data (e.g. the duration) of a growing file may change.
+
+    def __init__(self, plot, ecg, filename, png=False, title=''):
+        self.plot = plot
+        self.ecg = ecg
+        self.filename = filename
+        self.png = png
+        chain = plot.filters()
+        self.stream = chain.stream()
+        for i in plot.leads_to_plot:
+            logging.debug(u'%3s: %s' % (plot.LEAD_LABEL[i], '; '.join(chain.describe())))
+        # Filtered data not yet plotted, starting at plot.data_time0.
+        self.data = None
+        self.plot.data_time0 = 0.0
+        self.page_time0 = plot.time0
+        self.pages = 0
+        self.saved = []
+        self.pdf = None
+        if not png:
+            from reportlab.pdfgen import canvas
+            self.pdf = canvas.Canvas(filename, pagesize=(plot.paper_w*plot.unit, plot.paper_h*plot.unit))
+            self.pdf.setTitle(title)
+
+
+    def feed(self, chunk):
+        """ Add a (leads x samples) chunk, plot the pages which are complete """
+        self.append(self.stream.feed(chunk))
+        self.plot_pages(final=False)
+
+
+    def close(self):
+        """ Plot the remaining data, return the list of saved filenames """
+        self.append(self.stream.flush())
+        self.plot_pages(final=True)
+        if self.pdf is not None:
+            if self.pages > 0:
+                with metrics.stage(metrics.STAGE_WRITE):
+                    self.pdf.save()
+                metrics.count(metrics.BYTES_WRITTEN, os.path.getsize(self.filename))
+                self.saved.append(self.filename)
+            self.pdf = None
+        return self.saved
+
+
+    def append(self, y):
+        if y is not None:
+            self.data = y if self.data is None else np.concatenate((self.data, y), axis=1)
+
+
+    def plot_pages(self, final):
+        plot = self.plot
+        fs = float(contec.ECG90A_SAMPLE_RATE)
+        while self.data is not None:
+            # Discard the data preceding the page, but one sample.
+            skip = min(self.data.shape[1], max(0, int((self.page_time0 - plot.data_time0) * fs) - 1))
+            self.data = self.data[:, skip:]
+            plot.data_time0 += skip / fs
+            data_time1 = plot.data_time0 + self.data.shape[1] / fs
+            page_time1 = self.page_time0 + plot.page_duration()
+            if data_time1 < page_time1 and not (final and data_time1 > self.page_time0):
+                break
+            self.pages += 1
+            label = u'Page %d' % (self.pages,)
+            layer = plot.static_layer(self.ecg)
+            if self.png:
+                name = png_page_filename(self.filename, self.pages)
+                render_png_page(plot, layer, self.data, self.page_time0, label, name)
+                self.saved.append(name)
+            else:
+                plot.add_page(layer, self.data, self.page_time0, label)
+                plot.draw_pdf_page(self.pdf)
+            self.page_time0 = page_time1
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-resolution min/max pyramid of electrocardiogram lead data.
+
+Each level holds, for every lead, the minimum and the maximum of
+consecutive bins of samples; the bin size grows by FACTOR at each
+level. A renderer asks for the envelope of a lead over a sequence
+of plot columns: the coarsest level whose bins are not wider than a
+column is used, so the time needed depends only on the number of
+columns and not on the recording length, while peaks are kept.
+
+The pyramid of a recording can be stored into the ecg_cache
+directory, keyed by the recording contents, or saved into a NumPy
+.npz file.
+
+Required Python packages: python3-numpy
+"""
+
+import json
+import logging
+import os
+import numpy as np
+
+__author__ = "Niccolo Rigacci"
+__copyright__ = "Copyright 2020 Niccolo Rigacci <niccolo@rigacci.org>"
+__license__ = "GPLv3-or-later"
+__email__ = "niccolo@rigacci.org"
+__version__ = "0.1.0"
+
+PYRAMID_FORMAT = 'ecg_pyramid-1'
+# Kind and version of the ecg_cache entries.
+CACHE_KIND = 'pyramid'
+CACHE_VERSION = '1'
+# Samples in each bin of the first level, and growth factor of the following levels.
+DEFAULT_FACTOR = 4
+
+
+def build(data, sample_rate, time0=0.0, factor=DEFAULT_FACTOR):
+    """ Return the pyramid of (leads x samples) data, missing values are numpy.nan """
+    # Values are stored as float32, which holds the integer values
+    # of the recordings exactly. A bin containing only missing
+    # values is numpy.nan, otherwise missing values are ignored.
+    lo = hi = np.array(data, dtype=np.float32, ndmin=2)
+    mins, maxs = [], []
+    while lo.shape[1] > 1 or len(mins) == 0:
+        bins = -(-lo.shape[1] // factor)
+        pad = bins * factor - lo.shape[1]
+        if pad > 0:
+            fill = np.full((lo.shape[0], pad), np.nan, dtype=np.float32)
+            lo = np.concatenate((lo, fill), axis=1)
+            hi = np.concatenate((hi, fill), axis=1)
+        lo = np.fmin.reduce(lo.reshape((lo.shape[0], bins, factor)), axis=2)
+        hi = np.fmax.reduce(hi.reshape((hi.shape[0], bins, factor)), axis=2)
+        mins.append(lo)
+        maxs.append(hi)
+    return pyramid(mins, maxs, sample_rate, samples=np.shape(data)[-1], time0=time0, factor=factor)
+
+
+def load(filename):
+    """ Return the pyramid saved into filename by pyramid.save() """
+    with np.load(filename, allow_pickle=False) as npz:
+        meta = json.loads(str(npz['meta']))
+        if meta.get('format') != PYRAMID_FORMAT:
+            raise ValueError(u'File "%s" is not an ECG pyramid file' % (filename,))
+        arrays = dict((k, npz[k]) for k in npz.files if k != 'meta')
+    return from_arrays(meta, arrays)
+
+
+def from_arrays(meta, arrays):
+    """ Return the pyramid from the (meta, arrays) of pyramid.as_arrays() """
+    mins = [arrays['min_%d' % (k,)] for k in range(0, meta['levels'])]
+    maxs = [arrays['max_%d' % (k,)] for k in range(0, meta['levels'])]
+    return pyramid(mins, maxs, meta['sample_rate'], samples=meta['samples'], time0=meta['time0'], factor=meta['factor'])
+
+
+def for_recording(ecg, cache):
+    """ Return the pyramid of an ECG90A recording, stored into an ecg_cache.cache """
+    # If not cached, the pyramid is built from the whole recording.
+    key = cache.key(ecg.filename, CACHE_KIND, CACHE_VERSION)
+    entry = cache.get(key)
+    if entry is not None:
+        try:
+            return from_arrays(*entry)
+        except (KeyError, TypeError) as e:
+            logging.warning(u'Cannot read cached pyramid of "%s": %s' % (ecg.filename, e))
+    pyr = build(ecg.to_array(), ecg.sample_rate)
+    cache.put(key, *pyr.as_arrays())
+    return pyr
+
+
+class pyramid():
+    """ Min/max decimation levels of (leads x samples) data """
+
+    def __init__(self, mins, maxs, sample_rate, samples, time0=0.0, factor=DEFAULT_FACTOR):
+        # mins[k] and maxs[k] are (leads x bins) arrays, each bin of
+        # level k covers factor ** (k + 1) samples; time0 is the time
+        # (in seconds) of the first sample.
+        self.mins = mins
+        self.maxs = maxs
+        self.sample_rate = sample_rate
+        self.samples = samples
+        self.time0 = time0
+        self.factor = factor
+
+
+    def leads_count(self):
+        return self.mins[0].shape[0]
+
+
+    def bin_size(self, level):
+        """ Number of samples in each bin of a level """
+        return self.factor ** (level + 1)
+
+
+    def level_for(self, samples_per_column):
+        """ Return the coarsest level whose bins are not wider than samples_per_column """
+        level = 0
+        while level + 1 < len(self.mins) and self.bin_size(level + 1) <= samples_per_column:
+            level += 1
+        return level
+
+
+    def crop(self, t0, t1, samples_per_column):
+        """ Return the pyramid of the samples from t0 to t1 (seconds), for columns of samples_per_column """
+        # Levels coarser than the ones envelope() may use are dropped.
+        # The first sample is aligned to the bins of the coarsest level
+        # kept, so the bins and the envelopes do not change.
+        levels = min(len(self.mins), self.level_for(samples_per_column) + 2)
+        size = self.bin_size(levels - 1)
+        row0 = int(np.floor(max(0.0, (t0 - self.time0) * self.sample_rate) / size)) * size
+        row1 = int(np.ceil(min(float(self.samples), (t1 - self.time0) * self.sample_rate) / size)) * size
+        row1 = min(max(row0, row1), self.samples)
+        mins, maxs = [], []
+        for k in range(0, levels):
+            b = self.bin_size(k)
+            mins.append(self.mins[k][:, row0 // b:-(-row1 // b)])
+            maxs.append(self.maxs[k][:, row0 // b:-(-row1 // b)])
+        return pyramid(mins, maxs, self.sample_rate, samples=row1 - row0, time0=self.time0 + row0 / float(self.sample_rate), factor=self.factor)
+
+
+    def envelope(self, lead, times):
+        """ Return (mins, maxs) of a lead into the columns between consecutive times (seconds) """
+        # Columns are numpy.nan where there is no data. A column
+        # narrower than the bins of the first level gets the bin
+        # which contains its start.
+        samples = (np.asarray(times, dtype=np.float64) - self.time0) * self.sample_rate
+        columns = len(samples) - 1
+        if columns < 1:
+            return (np.empty(0), np.empty(0))
+        level = self.level_for(np.min(np.diff(samples)))
+        size = self.bin_size(level)
+        lo = self.mins[level][lead]
+        hi = self.maxs[level][lead]
+        bins = len(lo)
+        # Times are rounded to 1e-6 samples, against float errors at the bin edges.
+        edges = np.floor(np.round(samples, 6) / size).astype(np.int64)
+        start = edges[:-1]
+        stop = np.maximum(edges[1:], start + 1)
+        # Only the bins between the first and the last column are
+        # copied, with a trailing numpy.nan which lets reduceat() stop
+        # at the last bin; the fmin()/fmax() reductions ignore it.
+        index = np.clip(np.append(start, stop[-1]), 0, bins)
+        first, last = index[0], index[-1]
+        index -= first
+        mins = np.fmin.reduceat(np.append(lo[first:last], np.nan), index)[:-1].astype(np.float64)
+        maxs = np.fmax.reduceat(np.append(hi[first:last], np.nan), index)[:-1].astype(np.float64)
+        outside = (start >= bins) | (stop <= 0)
+        mins[outside] = np.nan
+        maxs[outside] = np.nan
+        return (mins, maxs)
+
+
+    def as_arrays(self):
+        """ Return (meta, arrays): a JSON serializable dictionary and a dictionary of arrays """
+        meta = {
+            'format': PYRAMID_FORMAT,
+            'levels': len(self.mins),
+            'sample_rate': self.sample_rate,
+            'samples': int(self.samples),
+            'time0': self.time0,
+            'factor': self.factor}
+        arrays = {}
+        for k in range(0, len(self.mins)):
+            arrays['min_%d' % (k,)] = self.mins[k]
+            arrays['max_%d' % (k,)] = self.maxs[k]
+        return (meta, arrays)
+
+
+    def save(self, filename):
+        """ Write the pyramid into a NumPy .npz file """
+        meta, arrays = self.as_arrays()
+        # Write to a temporary file first: the pyramid may be in use.
+        tmp_name = u'%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_name, filename)
@@ -5,8 +5,14 @@ Helper module to read and write SCP-ECG electrocardiogram files.
 It implements a limited subset of ANSI-AAMI EC71:2001 specifications.
 """
 
+import ecg_metrics as metrics
+
 import binascii
+import io
+import logging
+import os.path
 import struct
+import numpy as np
 
 __author__ = "Niccolo Rigacci"
 __copyright__ = "Copyright 2019-2020 Niccolo Rigacci <niccolo@rigacci.org>"
@@ -264,6 +270,33 @@ ENCODING = {
     ENCODING_SECOND_DIFF: u'Second difference'
 }
 
+# Section #2 - Huffman Tables
+# A code structure is (prefix bits, total bits, table mode switch, base value, base code).
+# If total bits exceed prefix bits, the original value follows the prefix.
+# If table mode switch is 0, the code selects the table number base value.
+HUFFMAN_CODE_STRUCT_LEN = 9
+DEFAULT_HUFFMAN_CODES = [
+    ( 1,  1, 1,  0, 0b0),
+    ( 3,  3, 1,  1, 0b100),
+    ( 3,  3, 1, -1, 0b101),
+    ( 4,  4, 1,  2, 0b1100),
+    ( 4,  4, 1, -2, 0b1101),
+    ( 5,  5, 1,  3, 0b11100),
+    ( 5,  5, 1, -3, 0b11101),
+    ( 6,  6, 1,  4, 0b111100),
+    ( 6,  6, 1, -4, 0b111101),
+    ( 7,  7, 1,  5, 0b1111100),
+    ( 7,  7, 1, -5, 0b1111101),
+    ( 8,  8, 1,  6, 0b11111100),
+    ( 8,  8, 1, -6, 0b11111101),
+    ( 9,  9, 1,  7, 0b111111100),
+    ( 9,  9, 1, -7, 0b111111101),
+    (10, 10, 1,  8, 0b1111111100),
+    (10, 10, 1, -8, 0b1111111101),
+    (10, 18, 1,  0, 0b1111111110),
+    (10, 26, 1,  0, 0b1111111111)
+]
+
 BIMODAL_COMPRESSION_FALSE = 0
 BIMODAL_COMPRESSION_TRUE = 1
 BIMODAL_COMPRESSION = {
@@ -274,6 +307,26 @@ BIMODAL_COMPRESSION = {
 MEASURE_NOT_COMPUTED = 29999
 MEASURE_LEAD_REJECTED = 29998
 MEASURE_WAVE_NOT_PRESENT = 19999
+AXIS_UNDEFINED = 999
+# Section #7 - Heart rate correction formula of QTc.
+QTC_UNKNOWN = 0
+QTC_BAZETT = 1
+QTC_HODGES = 2
+QTC_FORMULA = {
+    QTC_UNKNOWN: u'Unknown',
+    QTC_BAZETT: u'Bazett',
+    QTC_HODGES: u'Hodges'
+}
+
+# Version of the decoded data stored into ecg_cache, change it if decoding changes.
+CACHE_VERSION = '1'
+# Rows formatted at once by write_csv().
+CSV_CHUNK_ROWS = 4096
+
+class scp_error(Exception):
+    """ Invalid or unsupported SCP-ECG data """
+    pass
+
 
 def csv_format(val, none_as_zero=False, num_format=u'%.6f', multiplier=1):
     """ Return the value formatted as string suitable for CSV output """
@@ -285,6 +338,56 @@ def csv_format(val, none_as_zero=False, num_format=u'%.6f', multiplier=1):
     else:
         return num_format % (val * multiplier,)
 
+def write_csv(f, data, none_as_zero=False, num_format=u'%.6f', multiplier=1, header=None, sample_rate=None, time_format=u'%.6f', chunk_rows=CSV_CHUNK_ROWS):
+    """ Write (columns x samples) arrays of values into a CSV text stream """
+    # Output is the same of csv_format() applied to each value (NaN is
+    # None), but a block of chunk_rows rows is formatted with a single
+    # string operation. data can be an array or an iterable of arrays,
+    # e.g. chunks read from a file. header is a list of rows (lists
+    # of strings) to write first; if sample_rate is given, a time
+    # column (in seconds) is prepended.
+    if header is not None:
+        for row in header:
+            f.write(','.join(row) + '\n')
+    if isinstance(data, np.ndarray):
+        data = [data]
+    first_row = 0
+    for chunk in data:
+        for i in range(0, chunk.shape[1], chunk_rows):
+            block = chunk[:, i:i + chunk_rows].T
+            if multiplier != 1:
+                block = block * multiplier
+            cells = [num_format] * block.shape[1]
+            missing = np.isnan(block)
+            if not missing.any():
+                missing = None
+            elif none_as_zero:
+                block = np.where(missing, 0.0, block)
+                missing = None
+            elif not (missing.any(axis=0) & ~missing.all(axis=0)).any():
+                # Columns are either complete or empty (e.g. missing leads).
+                empty = missing.all(axis=0)
+                cells = [u'' if empty[j] else cells[j] for j in range(0, len(cells))]
+                block = block[:, ~empty]
+                missing = None
+            else:
+                block = block.astype(object)
+                block[missing] = u''
+            if sample_rate is not None:
+                cells.insert(0, time_format)
+                times = (np.arange(first_row, first_row + len(block)) / float(sample_rate)).reshape((-1, 1))
+                block = np.hstack((times.astype(block.dtype), block))
+                if missing is not None:
+                    missing = np.hstack((np.zeros((len(block), 1), dtype=bool), missing))
+            if missing is None:
+                row_format = ','.join(cells) + '\n'
+                f.write((row_format * len(block)) % tuple(block.ravel().tolist()))
+            else:
+                # Missing values use the %s format, to print an empty string.
+                formats = np.where(missing, u'%s', np.array(cells, dtype=object))
+                f.write('\n'.join(','.join(row) for row in formats.tolist()) % tuple(block.ravel().tolist()) + '\n')
+            first_row += len(block)
+
 def make_date(d):
     """ Return a 4-bytes SCP-ECG encoded date from a datetime object """
     return struct.pack('<H', d.year) + struct.pack('<B', d.month) + struct.pack('<B', d.day)
@@ -356,7 +459,7 @@ def parse_date(data):
     month = int.from_bytes(data[2:3], byteorder='little')
     day = int.from_bytes(data[3:4], byteorder='little')
     if (month < 1 or month > 12) or (day < 1 or day > 31):
-        print(u'WARNING: Invalid date: %d-%d-%d (%s)' % (year, month, day, data))
+        logging.warning(u'Invalid date: %d-%d-%d (%s)' % (year, month, day, data))
         year, month, day = 0, 0, 0
     return '%04d-%02d-%02d' % (year, month, day)
 
@@ -366,7 +469,7 @@ def parse_time(data):
     minutes = int.from_bytes(data[1:2], byteorder='little')
     seconds = int.from_bytes(data[2:3], byteorder='little')
     if (hours > 23 or minutes > 59 or seconds > 59):
-        print(u'WARNING: Invalid time: %d:%d:%d (%s)' % (hours, minutes, seconds, data))
+        logging.warning(u'Invalid time: %d:%d:%d (%s)' % (hours, minutes, seconds, data))
         hours, minutes, seconds = 0, 0, 0
     return '%02d:%02d:%02d' % (hours, minutes, seconds)
 
@@ -380,6 +483,32 @@ def parse_machine_id(data):
     return 'Inst. %d, Dept. %d, Dev. %d, Type %d, Model "%s"' % (institute_n, department_n, device_id, device_type, model)
 
 
+def reverse_bits(val, bits):
+    """ Return the integer with the lowest bits in reversed order """
+    return int(format(val, '0%db' % (bits,))[::-1], 2) if bits > 0 else 0
+
+def parse_huffman_tables(data):
+    """ Return the list of Huffman tables from the Section #2 data part """
+    # Each table is a list of code structures, the default table
+    # is returned if the Section contains the DEFAULT_HUFFMAN_TABLE code.
+    # Base codes are stored with the bits in reversed order.
+    tables_num = int.from_bytes(data[0:2], byteorder='little')
+    if tables_num == DEFAULT_HUFFMAN_TABLE:
+        return [DEFAULT_HUFFMAN_CODES]
+    tables = []
+    offset = 2
+    for t in range(0, tables_num):
+        codes_num = int.from_bytes(data[offset:offset+2], byteorder='little')
+        offset += 2
+        codes = []
+        for c in range(0, codes_num):
+            prefix_bits, total_bits, switch, base_value, base_code = struct.unpack('<BBBhI', data[offset:offset+HUFFMAN_CODE_STRUCT_LEN])
+            codes.append((prefix_bits, total_bits, switch, base_value, reverse_bits(base_code, prefix_bits)))
+            offset += HUFFMAN_CODE_STRUCT_LEN
+        tables.append(codes)
+    return tables
+
+
 def read_section_header(fp, offset):
     """ Read an SCP-ECG section header (16 bytes) and check the CRC """
     h = {}
@@ -393,8 +522,7 @@ def read_section_header(fp, offset):
     fp.seek(offset + 2)
     h['calc_crc'] = binascii.crc_hqx(fp.read(h['length'] - 2), 0xffff)
     if h['crc'] != h['calc_crc']:
-        print(u'ERROR: Section CRC check failed')
-        sys.exit(1)
+        raise scp_error(u'Section CRC check failed')
     return h
 
 
@@ -466,12 +594,154 @@ class second_diff():
         return val
 
 
+def reconstruct(diffs, encoding):
+    """ Return the sequence of values reconstructed from decoded data """
+    # Data can be a single lead or a (leads x samples) array, values are
+    # reconstructed along the last axis using cumulative sums. The result
+    # is the same as second_diff(): the first two values are taken as-is.
+    data = np.array(diffs, dtype=np.int64)
+    if encoding == ENCODING_FIRST_DIFF:
+        data = np.cumsum(data, axis=-1)
+    elif encoding == ENCODING_SECOND_DIFF and data.shape[-1] > 2:
+        diff1 = np.cumsum(data[..., 2:], axis=-1) + (data[..., 1] - data[..., 0])[..., np.newaxis]
+        data[..., 2:] = np.cumsum(diff1, axis=-1) + data[..., 1][..., np.newaxis]
+    return data
+
+
+def differences(values, encoding):
+    """ Return the sequence of differences to be stored, inverse of reconstruct() """
+    data = np.array(values, dtype=np.int64)
+    if encoding == ENCODING_FIRST_DIFF:
+        data[..., 1:] = np.diff(data, axis=-1)
+    elif encoding == ENCODING_SECOND_DIFF and data.shape[-1] > 2:
+        data[..., 2:] = np.diff(data, n=2, axis=-1)
+    return data
+
+
+def huffman_codes(values):
+    """ Return the default Huffman table (codes, lengths) arrays for values """
+    # Values from -8 to 8 have their own code, other values are stored
+    # as original 8 or 16 bit values after an escape prefix.
+    values = np.asarray(values, dtype=np.int64)
+    codes = np.zeros(len(values), dtype=np.int64)
+    lengths = np.zeros(len(values), dtype=np.int64)
+    orig_bits = np.where(np.abs(values) <= 8, 0, np.where((values >= -128) & (values <= 127), 8, 16))
+    for prefix_bits, total_bits, switch, base_value, base_code in DEFAULT_HUFFMAN_CODES:
+        bits = total_bits - prefix_bits
+        if bits == 0:
+            sel = (values == base_value)
+            codes[sel] = base_code
+        else:
+            sel = (orig_bits == bits)
+            codes[sel] = (base_code << bits) | (values[sel] & ((1 << bits) - 1))
+        lengths[sel] = total_bits
+    return (codes, lengths)
+
+
+def huffman_count(values, max_bytes):
+    """ Return how many values can be encoded into max_bytes """
+    codes, lengths = huffman_codes(values)
+    return int(np.searchsorted(np.cumsum(lengths), max_bytes * 8, side='right'))
+
+
+def huffman_encode(values):
+    """ Return values encoded with the default Huffman table as bytes """
+    codes, lengths = huffman_codes(values)
+    if len(codes) == 0:
+        return b''
+    # Expand each code into a row of bits, then keep only the used ones.
+    shifts = lengths[:, np.newaxis] - 1 - np.arange(0, int(lengths.max()))
+    bits = (codes[:, np.newaxis] >> np.maximum(shifts, 0)) & 1
+    return np.packbits(bits[shifts >= 0].astype(np.uint8)).tobytes()
+
+
+def make_lead_definition(lead_ids, samples):
+    """ Return the Section #3 data part for simultaneous leads of the same length """
+    flag_byte = ALL_SIMULTANEOUS_READ | (len(lead_ids) << 3)
+    data = struct.pack('<BB', len(lead_ids), flag_byte)
+    for lead_id in lead_ids:
+        data += struct.pack('<IIB', 1, samples, lead_id)
+    return data
+
+
+def make_global_measurements(rr_interval=MEASURE_NOT_COMPUTED, pp_interval=MEASURE_NOT_COMPUTED, blocks=(), qrs_types=(), ventricular_rate=MEASURE_NOT_COMPUTED, atrial_rate=MEASURE_NOT_COMPUTED, qtc=MEASURE_NOT_COMPUTED, qtc_formula=QTC_UNKNOWN):
+    """ Return the Section #7 (global measurements) data part """
+    # Each block is the tuple (P onset, P offset, QRS onset, QRS
+    # offset, T offset, P axis, QRS axis, T axis) of a reference beat
+    # type, in ms and degrees; qrs_types is the reference beat type
+    # of each QRS. No pacemaker spikes and no tagged fields.
+    data = struct.pack('<BBHH', len(blocks), 0, rr_interval, pp_interval)
+    for block in blocks:
+        data += struct.pack('<HHHHHhhh', *block)
+    data += struct.pack('<H', len(qrs_types)) + bytes(qrs_types)
+    data += struct.pack('<HHHBH', ventricular_rate, atrial_rate, qtc, qtc_formula, 0)
+    return data
+
+
+def make_rhythm_section(data, amplitude_multiplier, sample_time_interval, encoding=ENCODING_REAL, huffman=False):
+    """ Return the Section #6 data part and the number of samples stored for each lead """
+    # Data is a (leads x samples) array of integers. The bytes used to store
+    # each lead are limited by a 16 bit counter, so data is truncated to the
+    # number of samples that fit for all the leads.
+    max_bytes = 0xffff
+    if encoding != ENCODING_REAL:
+        diffs = differences(data, encoding)
+        if np.any(np.abs(diffs) > 32767):
+            logging.warning(u'Differences exceed 16 bit, using "%s" encoding' % (ENCODING[ENCODING_REAL],))
+            encoding = ENCODING_REAL
+    if encoding == ENCODING_REAL:
+        diffs = np.asarray(data)
+    if huffman:
+        # Each value takes at least one bit, do not look beyond max_bytes * 8 values.
+        count = min([huffman_count(lead[0:max_bytes * 8], max_bytes) for lead in diffs] + [diffs.shape[-1]])
+        leads = [huffman_encode(lead[0:count]) for lead in diffs]
+    else:
+        count = min(diffs.shape[-1], int(max_bytes / 2))
+        leads = [lead[0:count].astype('<i2').tobytes() for lead in diffs]
+    if count < diffs.shape[-1]:
+        logging.warning(u'Cannot store %d samples in SCP-ECG rhythm data, max is %d' % (diffs.shape[-1], count))
+    section = struct.pack('<HHBB', amplitude_multiplier, sample_time_interval, encoding, BIMODAL_COMPRESSION_FALSE)
+    section += struct.pack('<%dH' % (len(leads),), *[len(lead) for lead in leads])
+    return (section + b''.join(leads), count)
+
+
+def write_record(f, sections):
+    """ Write an SCP-ECG record to file, sections is a dictionary of data parts """
+    # Section pointers are required at least from #0 to #11.
+    sect_ids = range(0, max([MIN_POINTER_FIELDS] + [i + 1 for i in sections]))
+    length = SECTION_HEADER_LEN + POINTER_FIELD_LEN * len(sect_ids)
+    index = SCPECG_HEADER_LEN + 1
+    pointers = make_pointer_field(0, length, index)
+    index += length
+    parts = []
+    for sect_id in sect_ids[1:]:
+        data_part = sections.get(sect_id, b'')
+        length = 0
+        if len(data_part) > 0:
+            parts.append(pack_section(sect_id, data_part))
+            length = len(parts[-1])
+        pointers += make_pointer_field(sect_id, length, index)
+        index += length
+    parts.insert(0, pack_section(0, pointers))
+    # CRC(2bytes) + Size(4bytes) + Section #0 + Section #1 + ...
+    size = struct.pack('<I', SCPECG_HEADER_LEN + sum(len(p) for p in parts))
+    crc = binascii.crc_hqx(size, 0xffff)
+    for p in parts:
+        crc = binascii.crc_hqx(p, crc)
+    with metrics.stage(metrics.STAGE_WRITE):
+        f.write(struct.pack('<H', crc))
+        f.write(size)
+        for p in parts:
+            f.write(p)
+    metrics.count(metrics.BYTES_WRITTEN, SCPECG_HEADER_LEN + sum(len(p) for p in parts))
+
+
 class raw_decoder():
     """ Iterator yielding signed two-byte integers from data """
     def decode(self, data):
         words = len(data)
         if (words % 2) != 0:
-            print(u'WARNING: Data contains an odd number of bytes, shall be even')
+            logging.warning(u'Data contains an odd number of bytes, shall be even')
             words -= 1
         for i in range(0, words, 2):
             yield struct.unpack('<h', data[i:i+2])[0]
@@ -525,7 +795,7 @@ class huffman_decoder():
                         elif len(orig_bits_buffer) == 16:
                             orig_val = struct.unpack('<h', struct.pack('<H', int(orig_bits_buffer, 2)))[0]
                         else:
-                            print(u'ERROR: Invalid bit buffer length: %d' % (len(orig_bits_buffer),))
+                            logging.error(u'Invalid bit buffer length: %d' % (len(orig_bits_buffer),))
                             return
                         yield orig_val
                         orig_bits_buffer = ''
@@ -551,4 +821,317 @@ class huffman_decoder():
         #print(u'DEBUG: Iterator terminated')
         fmt = '{0:0%db}' % (size,)
         if size > 0:
-            print(u'WARNING: Unmatched Huffman prefix = %s' % (fmt.format(huffman_prefix),))
+            logging.warning(u'Unmatched Huffman prefix = %s' % (fmt.format(huffman_prefix),))
+
+
+class huffman_table_decoder():
+    """ Iterator yielding signed two-byte integers from Huffman encoded data """
+
+    # Each table is converted into a lookup list indexed by the next
+    # peek_bits of data, where peek_bits is the longest prefix in the table.
+    # Data is read through an integer bit buffer instead of bit by bit.
+
+    def __init__(self, tables=None):
+        if tables is None:
+            tables = [DEFAULT_HUFFMAN_CODES]
+        self.lookups = [self.make_lookup(codes) for codes in tables]
+
+    def make_lookup(self, codes):
+        """ Return (peek_bits, lookup) for a list of code structures """
+        peek_bits = max(c[0] for c in codes)
+        lookup = [None] * (1 << peek_bits)
+        for prefix_bits, total_bits, switch, base_value, base_code in codes:
+            # Entry is (prefix bits, original value bits, value, table to switch to).
+            if switch == 0:
+                entry = (prefix_bits, 0, None, base_value - 1)
+            else:
+                entry = (prefix_bits, total_bits - prefix_bits, base_value, None)
+            first = base_code << (peek_bits - prefix_bits)
+            for i in range(first, first + (1 << (peek_bits - prefix_bits))):
+                lookup[i] = entry
+        return (peek_bits, lookup)
+
+    def decode(self, data):
+        """ Iterator over data (bytes) """
+        peek_bits, lookup = self.lookups[0]
+        data_len = len(data)
+        pos = 0
+        buff = 0
+        buff_bits = 0
+        while True:
+            # Keep at least 32 bits into the buffer, when available.
+            if buff_bits < 32 and pos < data_len:
+                chunk = data[pos:pos+8]
+                pos += len(chunk)
+                buff = (buff << (len(chunk) * 8)) | int.from_bytes(chunk, byteorder='big')
+                buff_bits += len(chunk) * 8
+            if buff_bits == 0:
+                break
+            # Pad with zeros if less than peek_bits are left.
+            if buff_bits >= peek_bits:
+                entry = lookup[buff >> (buff_bits - peek_bits)]
+            else:
+                entry = lookup[buff << (peek_bits - buff_bits)]
+            if entry is None or entry[0] > buff_bits:
+                break
+            code_bits, orig_bits, value, switch = entry
+            buff_bits -= code_bits
+            if orig_bits > 0:
+                # Read the original value, with enough data into the buffer.
+                while buff_bits < orig_bits and pos < data_len:
+                    buff = (buff << 8) | data[pos]
+                    pos += 1
+                    buff_bits += 8
+                if buff_bits < orig_bits:
+                    buff_bits += code_bits
+                    break
+                buff_bits -= orig_bits
+                value = (buff >> buff_bits) & ((1 << orig_bits) - 1)
+                if value >= (1 << (orig_bits - 1)):
+                    value -= (1 << orig_bits)
+            buff &= (1 << buff_bits) - 1
+            if switch is not None:
+                peek_bits, lookup = self.lookups[switch]
+                continue
+            yield value
+        if buff_bits > 0:
+            fmt = '{0:0%db}' % (buff_bits,)
+            logging.warning(u'Unmatched Huffman prefix = %s' % (fmt.format(buff & ((1 << buff_bits) - 1)),))
+
+
+class reader():
+    """ Read an SCP-ECG file, sections are parsed on first access """
+
+    # Only the Section #0 pointers are read when the object is created;
+    # Sections #1, #2, #3 and #6 are read and parsed when first requested,
+    # so metadata queries do not read the rhythm data at all.
+
+    def __init__(self, filename, cache=None):
+        if not os.path.exists(filename):
+            raise scp_error(u'Input file "%s" does not exists' % (filename,))
+        self.filename = filename
+        # An ecg_cache.cache object, where decoded rhythm data is stored.
+        self.cache = cache
+        self.file_size = os.path.getsize(filename)
+        self.headers = {}
+        self.sections = {}
+        with metrics.stage(metrics.STAGE_HEADER), open(filename, 'rb') as f:
+            self.record_crc = int.from_bytes(f.read(2), byteorder='little')
+            self.record_length = int.from_bytes(f.read(4), byteorder='little')
+            if self.file_size != self.record_length:
+                raise scp_error(u'File length does not match record length')
+            # Section #0 is the Pointer Section (mandatory).
+            h = read_section_header(f, SCPECG_HEADER_LEN)
+            self.headers[0] = h
+            if h['reserved'] != b'SCPECG':
+                raise scp_error(u'Missing signature "SCPECG" in Section 0')
+            # Contains Pointer Fields for sections 0-11, plus manufacturer sections if any.
+            data_part_length = h['length'] - SECTION_HEADER_LEN
+            if (data_part_length % POINTER_FIELD_LEN) != 0:
+                logging.warning(u'Data part of section #0 is %d bytes, not a multiple of %d (pointer field size)' % (data_part_length, POINTER_FIELD_LEN))
+            pointer_fields = int(data_part_length / POINTER_FIELD_LEN)
+            if pointer_fields < MIN_POINTER_FIELDS:
+                logging.warning(u'Only %d pointer fields found, should be at least %d' % (pointer_fields, MIN_POINTER_FIELDS))
+            f.seek(SCPECG_HEADER_LEN + SECTION_HEADER_LEN)
+            self.pointers = {}
+            for i in range(0, pointer_fields):
+                section_id = int.from_bytes(f.read(2), byteorder='little')
+                section_len = int.from_bytes(f.read(4), byteorder='little')
+                section_index = int.from_bytes(f.read(4), byteorder='little')
+                if section_id != i:
+                    logging.warning(u'Searching section pointer %d, found Id %d' % (i, section_id))
+                self.pointers[section_id] = {'idx': section_index, 'length': section_len}
+            metrics.count(metrics.BYTES_READ, f.tell())
+
+
+    def check_record(self):
+        """ Check the CRC of the whole record, return the calculated CRC """
+        with open(self.filename, 'rb') as f:
+            f.seek(2)
+            self.calculated_crc = binascii.crc_hqx(f.read(self.record_length - 2), 0xffff)
+        if self.record_crc != self.calculated_crc:
+            raise scp_error(u'Record CRC check failed')
+        return self.calculated_crc
+
+
+    def has_section(self, sect_id):
+        return sect_id in self.pointers and self.pointers[sect_id]['length'] > 0
+
+
+    def section_data(self, sect_id):
+        """ Return the data part of a section, after checking its header """
+        if not self.has_section(sect_id):
+            raise scp_error(u'Section #%d not found' % (sect_id,))
+        # Section indexes are 1-based.
+        section_index = self.pointers[sect_id]['idx'] - 1
+        with open(self.filename, 'rb') as f:
+            h = read_section_header(f, section_index)
+            if h['id'] != sect_id:
+                raise scp_error(u'Searching section #%d, found Id %d' % (sect_id, h['id']))
+            self.headers[sect_id] = h
+            f.seek(section_index + SECTION_HEADER_LEN)
+            data = f.read(h['length'] - SECTION_HEADER_LEN)
+        metrics.count(metrics.BYTES_READ, SECTION_HEADER_LEN + len(data))
+        return data
+
+
+    def patient_data(self):
+        """ Return Section #1 as a list of (tag, tag_label, length, value) """
+        if 1 not in self.sections:
+            data = self.section_data(1)
+            fp = io.BytesIO(data)
+            params = []
+            while fp.tell() < len(data):
+                param = read_parameter(fp)
+                params.append(param)
+                if param[0] == TAG_EOF:
+                    break
+            self.sections[1] = params
+        return self.sections[1]
+
+
+    def tag_value(self, tag, default=None):
+        """ Return the value of a Section #1 tag """
+        for param in self.patient_data():
+            if param[0] == tag:
+                return param[3]
+        return default
+
+
+    def huffman_tables(self):
+        """ Return the Section #2 Huffman tables, None if data is not compressed """
+        if 2 not in self.sections:
+            if self.has_section(2):
+                self.sections[2] = parse_huffman_tables(self.section_data(2))
+            else:
+                self.sections[2] = None
+        return self.sections[2]
+
+
+    def lead_definition(self):
+        """ Return Section #3 as a dictionary """
+        if 3 not in self.sections:
+            data = self.section_data(3)
+            d = {}
+            d['leads_number'] = data[0]
+            d['flag_byte'] = data[1]
+            d['ref_beat'] = (data[1] & 0b00000001) == 0b001
+            d['simult_read'] = (data[1] & 0b00000100) == 0b100
+            d['lead_simult'] = (data[1] & 0b11111000) >> 3
+            d['leads'] = []
+            for i in range(0, d['leads_number']):
+                # Sample numbering is 1-based.
+                starting_sample, ending_sample, lead_id = struct.unpack('<IIB', data[2+i*9:11+i*9])
+                d['leads'].append({'id': lead_id, 'start': max(1, starting_sample), 'start_declared': starting_sample, 'end': ending_sample})
+            d['min_sample_num'] = min([l['start_declared'] for l in d['leads']], default=1)
+            d['max_sample_num'] = max([l['end'] for l in d['leads']], default=0)
+            if d['min_sample_num'] < 1:
+                logging.warning(u'Starting sample shall start with 1')
+            self.sections[3] = d
+        return self.sections[3]
+
+
+    def global_measurements(self):
+        """ Return Section #7 as a dictionary, None if not present """
+        if 7 not in self.sections:
+            if not self.has_section(7):
+                return None
+            data = self.section_data(7)
+            d = {}
+            blocks, spikes, d['rr_interval'], d['pp_interval'] = struct.unpack('<BBHH', data[0:6])
+            offset = 6
+            d['blocks'] = []
+            for i in range(0, blocks):
+                d['blocks'].append(dict(zip(('p_onset', 'p_offset', 'qrs_onset', 'qrs_offset', 't_offset', 'p_axis', 'qrs_axis', 't_axis'), struct.unpack('<HHHHHhhh', data[offset:offset+16]))))
+                offset += 16
+            # Pacemaker spikes measurements and info are skipped.
+            offset += spikes * (4 + 6)
+            if len(data) >= offset + 2:
+                count = struct.unpack('<H', data[offset:offset+2])[0]
+                d['qrs_types'] = list(data[offset+2:offset+2+count])
+                offset += 2 + count
+            if len(data) >= offset + 7:
+                d['ventricular_rate'], d['atrial_rate'], d['qtc'], d['qtc_formula'] = struct.unpack('<HHHB', data[offset:offset+7])
+            self.sections[7] = d
+        return self.sections[7]
+
+
+    def rhythm_header(self):
+        """ Return the Section #6 header fields as a dictionary """
+        if 6 not in self.sections:
+            leads_number = self.lead_definition()['leads_number']
+            if not self.has_section(6):
+                raise scp_error(u'Section #6 (rhythm data) not found')
+            # Read only the header fields, without the rhythm data.
+            section_index = self.pointers[6]['idx'] - 1
+            with open(self.filename, 'rb') as f:
+                f.seek(section_index + SECTION_HEADER_LEN)
+                data = f.read(6 + 2 * leads_number)
+            d = {}
+            d['amplitude_multiplier'], d['sample_time_interval'], d['encoding'], d['bimodal_compr'] = struct.unpack('<HHBB', data[0:6])
+            d['stored_bytes'] = list(struct.unpack('<%dH' % (leads_number,), data[6:]))
+            if d['encoding'] not in ENCODING:
+                raise scp_error(u'Unknown encoding mode %d, I known only "%s"' % (d['encoding'], ENCODING))
+            if d['bimodal_compr'] not in BIMODAL_COMPRESSION:
+                raise scp_error(u'Unknown compression %d' % (d['bimodal_compr'],))
+            self.sections[6] = d
+        return self.sections[6]
+
+
+    def sample_rate(self):
+        """ Return the sample rate in Hz """
+        return 1000000.0 / self.rhythm_header()['sample_time_interval']
+
+
+    def rhythm_data(self):
+        """ Return Section #6 as a (leads x samples) array, missing values are numpy.nan """
+        if 'rhythm' not in self.sections and self.cache is not None:
+            key = self.cache.key(self.filename, u'scp', CACHE_VERSION)
+            entry = self.cache.get(key)
+            if entry is not None:
+                meta, arrays = entry
+                self.sections[3] = meta['lead_definition']
+                self.sections[6] = meta['rhythm_header']
+                self.decoded_samples = meta['decoded_samples']
+                self.sections['rhythm'] = arrays['rhythm']
+            else:
+                rhythm = self.decode_rhythm()
+                meta = {'lead_definition': self.lead_definition(), 'rhythm_header': self.rhythm_header(), 'decoded_samples': self.decoded_samples}
+                self.cache.put(key, meta, {'rhythm': rhythm})
+        return self.decode_rhythm()
+
+
+    def decode_rhythm(self):
+        """ Decode Section #6 data, without using the cache """
+        if 'rhythm' not in self.sections:
+            with metrics.stage(metrics.STAGE_DECODE):
+                lead_def = self.lead_definition()
+                if lead_def['ref_beat']:
+                    raise scp_error(u'Unsupported rhythm using reference beat compression')
+                header = self.rhythm_header()
+                tables = self.huffman_tables()
+                data = self.section_data(6)
+                offset = 6 + 2 * lead_def['leads_number']
+                rhythm = np.full((lead_def['leads_number'], lead_def['max_sample_num']), np.nan)
+                self.decoded_samples = []
+                for lead in range(0, lead_def['leads_number']):
+                    data_bytes = data[offset:offset+header['stored_bytes'][lead]]
+                    offset += header['stored_bytes'][lead]
+                    if header['bimodal_compr'] != BIMODAL_COMPRESSION_FALSE:
+                        logging.warning(u'Unsupported "%s" compression' % (BIMODAL_COMPRESSION[header['bimodal_compr']],))
+                        self.decoded_samples.append(0)
+                        continue
+                    if tables is not None:
+                        values = np.fromiter(huffman_table_decoder(tables).decode(data_bytes), dtype=np.int64)
+                    else:
+                        values = np.frombuffer(data_bytes[0:len(data_bytes) & ~1], dtype='<i2')
+                    # TODO: Is there a value for NULL?
+                    values = reconstruct(values, header['encoding'])
+                    # Actual number of samples can differ from Section #3 declarations.
+                    self.decoded_samples.append(len(values))
+                    start = lead_def['leads'][lead]['start'] - 1
+                    values = values[0:max(0, rhythm.shape[1] - start)]
+                    rhythm[lead, start:start+len(values)] = values
+                self.sections['rhythm'] = rhythm
+            metrics.count(metrics.SAMPLES_DECODED, max(self.decoded_samples, default=0))
+        return self.sections['rhythm']
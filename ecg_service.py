@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service rendering ECG90A and SCP-ECG recordings into PDF
+or PNG pages, with the same options of ecg2pdf.
+
+Pages are rendered by a pool of worker processes, which import the
+plotting modules and register the fonts once, when they start. The
+rendered pages are kept into a bounded LRU cache: identical requests
+are served from memory, and identical requests arriving while the
+page is being rendered wait for the same job.
+
+Requests:
+
+    GET  /render?path=<file>&<options>    render a file below the root directory
+    POST /render?<options>                render the recording in the request body
+    GET  /stats                           queue depth, cache and latency statistics
+
+Options are leads, format, speed, ampli, notch, lowpass, time0 and
+png, e.g. /render?path=0000037.ECG&format=3x4&lowpass=40&png=1.
+
+Required custom modules: ecg_contec.py, ecg_scp.py, ecg_catalog.py, ecg_cache.py, ecg_plot.py
+Required Python packages: python3-numpy python3-scipy python3-reportlab
+"""
+
+import ecg_cache
+import ecg_catalog
+import ecg_contec as contec
+import ecg_scp as scp
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import tempfile
+import threading
+import time
+import urllib.parse
+import numpy as np
+
+__author__ = "Niccolo Rigacci"
+__copyright__ = "Copyright 2020 Niccolo Rigacci <niccolo@rigacci.org>"
+__license__ = "GPLv3-or-later"
+__email__ = "niccolo@rigacci.org"
+__version__ = "0.1.0"
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8090
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_UPLOAD = 64 * 1024 * 1024
+# Latencies kept to calculate the percentiles.
+LATENCY_SAMPLES = 1000
+PERCENTILES = [50, 90, 99]
+# Same defaults of ecg2pdf.
+DEFAULT_OPTIONS = {
+    'leads': list(range(0, 12)),
+    'rows': 6,
+    'cols': 2,
+    'speed': 25.0,
+    'ampli': None,
+    'notch': None,
+    'lowpass': None,
+    'time0': 0.0,
+    'png': False}
+CONTENT_TYPE = {False: 'application/pdf', True: 'image/png'}
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 422: 'Unprocessable Entity', 500: 'Internal Server Error'}
+# Mapping from SCP-ECG lead IDs to ECG90A lead indexes.
+SCP_LEADS = dict((v, k) for k, v in contec.ECG90A_LEADS_SCP.items())
+# Seconds to wait for all the worker processes to start.
+START_TIMEOUT = 60.0
+
+# Barrier of the worker processes being started, set by warm_up().
+_start_barrier = None
+
+
+class request_error(Exception):
+    """ An error to be returned to the client with an HTTP status """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def parse_options(query):
+    """ Return the rendering options from a dictionary of query strings, as ecg2pdf parses them """
+    options = dict(DEFAULT_OPTIONS)
+    try:
+        if 'leads' in query:
+            options['leads'] = [int(lead) - 1 for lead in query['leads'].split(',') if 1 <= int(lead) <= 12]
+        if 'format' in query:
+            rows, cols = query['format'].split('x')
+            options['rows'], options['cols'] = int(rows), int(cols)
+        for name in ('speed', 'ampli', 'notch', 'lowpass', 'time0'):
+            if name in query:
+                options[name] = float(query[name])
+        if 'png' in query:
+            options['png'] = query['png'].lower() in ('1', 'true', 'yes')
+    except ValueError:
+        raise request_error(400, u'Invalid parameter value')
+    if options['rows'] < 1 or options['cols'] < 1 or options['speed'] <= 0 or options['time0'] < 0:
+        raise request_error(400, u'Invalid parameter value')
+    return options
+
+
+def file_format(filename):
+    """ Return the format of a recording from its contents """
+    # SCP-ECG records contain the "SCPECG" signature in the Section #0 header.
+    with open(filename, 'rb') as f:
+        head = f.read(scp.SCPECG_HEADER_LEN + scp.SECTION_HEADER_LEN)
+    if head[scp.SCPECG_HEADER_LEN + 10:scp.SCPECG_HEADER_LEN + 16] == b'SCPECG':
+        return ecg_catalog.FORMAT_SCP
+    return ecg_catalog.FORMAT_CONTEC
+
+
+class scp_recording():
+    """ SCP-ECG file with the attributes and the window() method of an ecg_contec.ecg, used by ecg_plot """
+
+    def __init__(self, filename, cache=None):
+        # Leads are resampled to the ECG90A sample rate and scaled to
+        # the ECG90A amplitude units; leads not found are numpy.nan.
+        row, tags = ecg_catalog.scp_row(filename)
+        if row['err'] != 0 or 'samples' not in row:
+            raise scp.scp_error(u'Cannot parse SCP-ECG file "%s"' % (filename,))
+        reader = scp.reader(filename, cache=cache)
+        rhythm = reader.rhythm_data()
+        lead_def = reader.lead_definition()
+        scale = reader.rhythm_header()['amplitude_multiplier'] / float(contec.ECG90A_AMPL_NANOVOLT)
+        self.sample_rate = contec.ECG90A_SAMPLE_RATE
+        self.samples = int(rhythm.shape[1] * self.sample_rate / reader.sample_rate())
+        self.duration = float(self.samples / self.sample_rate)
+        times = np.arange(0, self.samples) * (reader.sample_rate() / self.sample_rate)
+        self.data = np.full((contec.ECG90A_DATA_SERIES + 4, self.samples), np.nan)
+        for k, lead in enumerate(lead_def['leads']):
+            if lead['id'] in SCP_LEADS:
+                values = rhythm[k] if len(times) == rhythm.shape[1] else np.interp(times, np.arange(0, rhythm.shape[1]), rhythm[k])
+                self.data[SCP_LEADS[lead['id']]] = np.round(values * scale)
+        self.filename = filename
+        self.err = 0
+        self.case = row['case_id'] or u''
+        self.timestamp = row['timestamp'] or u''
+        self.patient_name = row['patient_name']
+        self.patient_sex = row['patient_sex']
+        self.patient_sex_label = contec.SEX_LABELS[self.patient_sex]
+        self.patient_age = row['patient_age']
+        self.patient_weight = row['patient_weight']
+
+
+    def window(self, t0, t1=None, leads=None):
+        """ Return data from t0 to t1 (seconds) as a (leads x samples) array """
+        row0 = min(max(0, int(round(t0 * self.sample_rate))), self.samples)
+        row1 = self.samples if t1 is None else min(max(row0, int(round(t1 * self.sample_rate))), self.samples)
+        data = self.data[:, row0:row1]
+        return data if leads is None else data[list(leads)]
+
+
+def open_recording(filename, cache=None):
+    """ Return an ecg_contec.ecg or an scp_recording, from the file contents """
+    if file_format(filename) == ecg_catalog.FORMAT_SCP:
+        return scp_recording(filename, cache=cache)
+    ecg = contec.ecg(filename, mmap=True, cache=cache)
+    if ecg.err != 0:
+        raise ValueError(u'ECG file header did not parsed correctly')
+    return ecg
+
+
+def warm_up(barrier=None):
+    """ Worker initializer: import the plotting modules and register the fonts """
+    global _start_barrier
+    _start_barrier = barrier
+    import ecg_plot
+    import ecg_filter
+    from reportlab.graphics import renderPDF, renderPM
+    ecg_plot.register_fonts()
+    ecg_filter.design(ecg_filter.LOWPASS, 40.0, 2, contec.ECG90A_SAMPLE_RATE)
+
+
+def ping():
+    """ Return the worker pid, after all the workers called ping() """
+    # While a worker waits it is not idle, so the executor starts a
+    # new process for the next ping(), until all the jobs are running.
+    if _start_barrier is not None:
+        try:
+            _start_barrier.wait(START_TIMEOUT)
+        except threading.BrokenBarrierError:
+            pass
+    return os.getpid()
+
+
+def render(filename, options, cache_dir=None):
+    """ Render a page as ecg2pdf does, return the (PDF or PNG bytes, error flags) """
+    # Executed into a worker process.
+    from ecg_plot import ecg_plot, PDF_UNIT, PNG_UNIT
+    cache = None if cache_dir is None else ecg_cache.cache(cache_dir)
+    ecg = open_recording(filename, cache=cache)
+    png = options['png']
+    plot = ecg_plot(unit=PNG_UNIT if png else PDF_UNIT, cols=options['cols'], rows=options['rows'], time0=options['time0'], ampli=options['ampli'], speed=options['speed'])
+    plot.leads_to_plot = options['leads']
+    plot.data_time0 = max(0.0, plot.time0 - plot.DATA_PADDING)
+    plot.lowpass = options['lowpass']
+    plot.notch = options['notch']
+    title = 'ECG %s %dx%d t0=%.1fsec' % (ecg.case, options['rows'], options['cols'], options['time0'])
+    with tempfile.TemporaryDirectory(prefix='ecg-service-') as tmp:
+        name = os.path.join(tmp, 'page.png' if png else 'page.pdf')
+        lead_data = ecg.window(plot.data_time0, plot.time1 + plot.DATA_PADDING)
+        plot.add_graph_paper()
+        plot.add_case_data(ecg)
+        plot.add_patient_data(ecg)
+        plot.add_plot_info_text()
+        plot.add_lead_plots(lead_data)
+        plot.add_plot_filter_text()
+        plot.save(name, png=png, title=title)
+        with open(name, 'rb') as f:
+            return (f.read(), ecg.err)
+
+
+class result_cache():
+    """ LRU cache of rendered pages, bounded by the total size in bytes """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+
+    def put(self, key, value):
+        """ Store value (bytes, err), evicting the least recently used entries """
+        size = len(value[0])
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= len(self.entries.pop(key)[0])
+        self.entries[key] = value
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.nbytes -= len(old_value[0])
+
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+class latency_stats():
+    """ Percentiles of the last LATENCY_SAMPLES latencies, in seconds """
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.latencies = collections.deque(maxlen=samples)
+        self.count = 0
+
+
+    def add(self, seconds):
+        self.latencies.append(seconds)
+        self.count += 1
+
+
+    def stats(self):
+        d = {'count': self.count}
+        if len(self.latencies) > 0:
+            values = np.percentile(np.array(self.latencies), PERCENTILES)
+            for p, v in zip(PERCENTILES, values):
+                d['p%d_ms' % (p,)] = float(v) * 1000.0
+        return d
+
+
+class service():
+    """ Render requests queued to a pool of worker processes, with a result cache """
+
+    def __init__(self, jobs=None, root='.', cache_bytes=DEFAULT_CACHE_BYTES, cache_dir=None, max_upload=DEFAULT_MAX_UPLOAD):
+        # Files are searched below the root directory; cache_dir is
+        # where the workers cache decoded data (None for no cache).
+        self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        self.root = os.path.realpath(root)
+        self.cache_dir = cache_dir
+        self.max_upload = max_upload
+        self.results = result_cache(cache_bytes)
+        self.latency = {'all': latency_stats(), 'hit': latency_stats(), 'render': latency_stats()}
+        self.pending = 0
+        self.errors = 0
+        self.in_flight = {}
+        self.executor = None
+        self.started = time.time()
+
+
+    async def start(self):
+        """ Start the worker processes, each one warmed up """
+        barrier = multiprocessing.Barrier(self.jobs)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs, initializer=warm_up, initargs=(barrier,))
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*[loop.run_in_executor(self.executor, ping) for i in range(0, self.jobs)])
+        if len(set(pids)) < self.jobs:
+            logging.warning(u'Started only %d of %d worker processes' % (len(set(pids)), self.jobs))
+        else:
+            logging.info(u'Started %d worker processes' % (len(set(pids)),))
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+    def resolve(self, path):
+        """ Return the real path of a file below the root directory """
+        filename = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, filename]) != self.root:
+            raise request_error(403, u'Path is outside the served directory')
+        if not os.path.isfile(filename):
+            raise request_error(404, u'File not found')
+        return filename
+
+
+    async def render(self, options, path=None, body=None):
+        """ Return (bytes, err, cache hit) of a page, from a file path or from uploaded data """
+        t0 = time.perf_counter()
+        if path is not None:
+            filename = self.resolve(path)
+            st = os.stat(filename)
+            source = [filename, st.st_size, st.st_mtime_ns]
+        else:
+            source = hashlib.sha1(body).hexdigest()
+        key = hashlib.sha1(json.dumps([source, options], sort_keys=True).encode('utf-8')).hexdigest()
+        result = self.results.get(key)
+        hit = result is not None
+        if not hit:
+            if key not in self.in_flight:
+                self.in_flight[key] = asyncio.ensure_future(self.run_job(options, filename if path is not None else None, body))
+                self.in_flight[key].add_done_callback(lambda f: self.in_flight.pop(key, None))
+            result = await asyncio.shield(self.in_flight[key])
+            self.results.put(key, result)
+        elapsed = time.perf_counter() - t0
+        self.latency['all'].add(elapsed)
+        self.latency['hit' if hit else 'render'].add(elapsed)
+        return result + (hit,)
+
+
+    async def run_job(self, options, filename, body):
+        """ Run a render job into the pool; uploaded data is saved into a temporary file """
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        tmp_name = None
+        try:
+            if filename is None:
+                fd, tmp_name = tempfile.mkstemp(prefix='ecg-service-', suffix='.upload')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(body)
+                filename = tmp_name
+            # Uploads are not kept into the decoded data cache.
+            cache_dir = self.cache_dir if tmp_name is None else None
+            try:
+                return await loop.run_in_executor(self.executor, render, filename, options, cache_dir)
+            except (ValueError, scp.scp_error) as e:
+                raise request_error(422, str(e))
+        finally:
+            self.pending -= 1
+            if tmp_name is not None:
+                os.unlink(tmp_name)
+
+
+    def stats(self):
+        """ Return the queue depth, cache and latency statistics """
+        return {
+            'uptime': time.time() - self.started,
+            'workers': self.jobs,
+            'pending': self.pending,
+            'running': min(self.pending, self.jobs),
+            'queued': max(0, self.pending - self.jobs),
+            'errors': self.errors,
+            'cache': self.results.stats(),
+            'latency': dict((name, s.stats()) for name, s in self.latency.items())}
+
+
+    async def handle(self, reader, writer):
+        """ Serve one HTTP/1.1 request, then close the connection """
+        try:
+            status, headers, body = await self.respond(reader)
+        except request_error as e:
+            status, headers, body = e.status, {'Content-Type': 'text/plain; charset=utf-8'}, (str(e) + '\n').encode('utf-8')
+        except Exception as e:
+            logging.error(u'Unexpected error: %s' % (e,))
+            status, headers, body = 500, {'Content-Type': 'text/plain; charset=utf-8'}, b'Internal error\n'
+        if status != 200:
+            self.errors += 1
+        head = u'HTTP/1.1 %d %s\r\n' % (status, HTTP_STATUS[status])
+        headers.update({'Content-Length': str(len(body)), 'Connection': 'close'})
+        for name in headers:
+            head += u'%s: %s\r\n' % (name, headers[name])
+        try:
+            writer.write((head + u'\r\n').encode('latin-1') + body)
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+
+    async def respond(self, reader):
+        """ Read a request, return (status, headers, body) of the response """
+        try:
+            request_line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            method, target, version = request_line.split(' ')
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+                if line == u'':
+                    break
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', '0'))
+            if length > self.max_upload:
+                raise request_error(413, u'Upload larger than %d bytes' % (self.max_upload,))
+            body = await reader.readexactly(length) if length > 0 else b''
+        except (ValueError, asyncio.IncompleteReadError):
+            raise request_error(400, u'Malformed request')
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/stats':
+            return (200, {'Content-Type': 'application/json'}, json.dumps(self.stats(), indent=1, sort_keys=True).encode('utf-8'))
+        if url.path != '/render':
+            raise request_error(404, u'Unknown path')
+        options = parse_options(query)
+        if method == 'GET':
+            if 'path' not in query:
+                raise request_error(400, u'Missing parameter: path')
+            data, err, hit = await self.render(options, path=query['path'])
+        elif method == 'POST':
+            if length == 0:
+                raise request_error(400, u'Missing recording data')
+            data, err, hit = await self.render(options, body=body)
+        else:
+            raise request_error(405, u'Method not allowed')
+        headers = {'Content-Type': CONTENT_TYPE[options['png']], 'X-Cache': 'hit' if hit else 'miss', 'X-Ecg-Err': '0x%02X' % (err,)}
+        return (200, headers, data)
+
+
+    async def serve_forever(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        await self.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        logging.info(u'Listening on http://%s:%d/, serving files below "%s"' % (host, port, self.root))
+        async with server:
+            await server.serve_forever()